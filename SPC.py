@@ -15,6 +15,18 @@ Changepoint is added, when changepoints are set, the calculations are made in th
 
 """
 
+import asyncio
+import hashlib
+import json
+import math
+import os
+import time
+import warnings
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from multiprocessing import shared_memory
+
 import numpy as np
 
 
@@ -30,8 +42,11 @@ CHART_C = "c"
 CHART_U = "u"
 CHART_EWMA = "EWMA"
 CHART_CUSUM = "CUSUM"
+CHART_CUSUM_TABULAR = "CUSUM tabular"
 CHART_THREE_WAY = "three way"
 CHART_TIME_SERIES = "time series"
+CHART_T2 = "Hotelling T2"
+CHART_MEWMA = "MEWMA"
 
 RULES_1_BEYOND_3SIGMA = "1 beyond 3*sigma"
 RULES_2_OF_3_BEYOND_2SIGMA = "2 of 3 beyond 2*sigma"
@@ -153,6 +168,207 @@ def test_beyond_1_sigma_both_sides(data, center, lcl, ucl):
             return False
     return True
 
+
+def _as_float(data, dtype=None):
+    """
+    data as a float ndarray of dtype. Without dtype a floating ndarray is
+    taken as it is (float32 stays float32), anything else becomes float64.
+    Nothing is copied when the input already fits.
+    """
+    if dtype is None:
+        if isinstance(data, np.ndarray) and data.dtype.kind == 'f':
+            return data
+        dtype = float
+    return np.asarray(data, dtype=dtype)
+
+
+# Rules are declared as small specs and compiled once into vectorized
+# kernels. A kernel gets the whole series classified into zones and returns
+# a boolean mask that is True at i when the window of points ending at i
+# violates the rule. A 2D array is handled as one series per column, with
+# limits per column. The test_* functions above are the reference, one
+# window at a time, of the built-in rules.
+
+RULE_ZONE = "zone"
+RULE_ONE_SIDE = "one side"
+RULE_TRENDING = "trending"
+RULE_ALTERNATING = "alternating"
+
+# where the points of a zone rule are counted
+SIDE_SAME = "same"  # beyond sigma, all on the same side of the center
+SIDE_EITHER = "either"  # beyond sigma, on any side
+SIDE_WITHIN = "within"  # within sigma of the center
+
+
+def rule_zone(count, points, sigma, side=SIDE_SAME):
+    """
+    count of points points beyond (or within) sigma of the center, the
+    limits being at 3 sigma. E.g. rule_zone(3, 4, 1.5) is 3 of 4 points
+    beyond 1.5 sigma on the same side.
+    """
+    assert 1 <= count <= points
+    assert sigma > 0
+    assert side in (SIDE_SAME, SIDE_EITHER, SIDE_WITHIN)
+    return {'kind': RULE_ZONE, 'count': count, 'points': points, 'sigma': sigma, 'side': side}
+
+
+def rule_one_side(points):
+    """points points in a row on one side of the center"""
+    assert points >= 2
+    return {'kind': RULE_ONE_SIDE, 'points': points}
+
+
+def rule_trending(points):
+    """points points in a row steadily increasing or decreasing"""
+    assert points >= 3
+    return {'kind': RULE_TRENDING, 'points': points}
+
+
+def rule_alternating(points):
+    """points points in a row alternating up and down"""
+    assert points >= 3
+    return {'kind': RULE_ALTERNATING, 'points': points}
+
+
+def _sigma_bounds(center, lcl, ucl, sigma):
+    """Upper and lower border of sigma, computed exactly as in the test_* functions."""
+    if sigma == 3:
+        return ucl, lcl
+    if sigma == 1:
+        return center+(ucl-center)/3, center-(center-lcl)/3
+    return center+(ucl-center)*sigma/3, center-(center-lcl)*sigma/3
+
+
+class Zones(dict):
+    """
+    Flags of every point of a series against the center line and the sigma
+    zones, computed on first use and kept for the other rules. Keys are the
+    neighbour pair flags ('cross', 'up', ...) and (flag, sigma) tuples for
+    the zones ('above', 'below', 'inside', 'outside').
+    """
+
+    def __init__(self, data, center, lcl, ucl):
+        dict.__init__(self, data=data)
+        self.center = center
+        self.lcl = lcl
+        self.ucl = ucl
+        self.limits = lcl is not None and ucl is not None
+
+    def __missing__(self, key):
+        data = self['data']
+        shape = data.shape
+        if key == 'cross':
+            # a sign change between neighbours breaks a run on one side
+            dev = data - self.center
+            value = _pair_flags(dev[:-1]*dev[1:] < 0, shape)
+        elif key == 'up':
+            value = _pair_flags(data[1:] > data[:-1], shape)
+        elif key == 'down':
+            value = _pair_flags(data[1:] < data[:-1], shape)
+        elif key == 'not_up':
+            value = _pair_flags(data[1:] <= data[:-1], shape)
+        elif key == 'not_down':
+            value = _pair_flags(data[1:] >= data[:-1], shape)
+        elif key == 'unordered':
+            value = ~self['up'] & ~self['down'] & _pair_flags(data[1:] != data[:-1], shape)
+        else:
+            flag, sigma = key
+            upper, lower = _sigma_bounds(self.center, self.lcl, self.ucl, sigma)
+            if flag == 'above':
+                value = data > upper
+            elif flag == 'below':
+                value = data < lower
+            elif flag == 'inside':
+                value = (data < upper) & (data > lower)
+            else:
+                value = ((data > upper) & (data > self.center)) | ((data < lower) & (data < self.center))
+        self[key] = value
+        return value
+
+
+def classify_zones(data, center, lcl, ucl):
+    """Classify every point against the center line and the sigma zones, see Zones."""
+    return Zones(_as_float(data), center, lcl, ucl)
+
+
+def _pair_flags(flags, shape):
+    """Place flags computed for neighbour pairs at the index of the later point."""
+    out = np.zeros(shape, dtype=bool)
+    out[1:] = flags
+    return out
+
+
+def _window_count(flags, points_num):
+    """Count True flags in the window of points_num flags ending at each index."""
+    if points_num == 1:
+        return flags.astype(np.int64)
+    cnt = np.zeros(flags.shape, dtype=np.int64)
+    if points_num <= 0 or len(flags) < points_num:
+        return cnt
+    cs = np.zeros((len(flags)+1,) + flags.shape[1:], dtype=np.int64)
+    np.cumsum(flags, axis=0, dtype=np.int64, out=cs[1:])
+    cnt[points_num-1:] = cs[points_num:] - cs[:-points_num]
+    return cnt
+
+
+def _zone_kernel(count, points, sigma, side):
+    above, below, inside, outside = [(f, sigma) for f in ('above', 'below', 'inside', 'outside')]
+    if side == SIDE_SAME and points == 1:
+        return lambda zones: zones[above] | zones[below]
+    if side == SIDE_SAME:
+        return lambda zones: ((_window_count(zones[above], points) >= count) |
+                              (_window_count(zones[below], points) >= count))
+    if side == SIDE_EITHER:
+        # points on a border are not inside
+        return lambda zones: points - _window_count(zones[inside], points) >= count
+    return lambda zones: points - _window_count(zones[outside], points) >= count
+
+
+def _one_side_kernel(points):
+    # points points are joined by points-1 neighbour pairs
+    return lambda zones: _window_count(zones['cross'], points-1) == 0
+
+
+def _trending_kernel(points):
+    # the first pair of the window sets the direction, the rest must follow it
+    rest = points-2
+
+    def kernel(zones):
+        n = len(zones['data'])
+        first = np.zeros(n, dtype=int)
+        first[points-1:] = np.arange(1, n-points+2)
+        up = zones['up'][first] & (_window_count(zones['not_up'], rest) == 0)
+        down = zones['down'][first] & (_window_count(zones['not_down'], rest) == 0)
+        # unordered values (NaN) in the first pair are reported as a trend
+        return up | down | zones['unordered'][first]
+    return kernel
+
+
+def _alternating_kernel(points):
+    def kernel(zones):
+        up = zones['up']
+        down = zones['down']
+        # two moves in the same direction in a row break the alternation
+        same = np.zeros(up.shape, dtype=bool)
+        same[2:] = (up[1:-1] & up[2:]) | (down[1:-1] & down[2:])
+        return _window_count(same, points-2) == 0
+    return kernel
+
+
+def compile_rule(spec):
+    """Compile a rule spec into a kernel: zones -> mask over the whole series."""
+    kind = spec['kind']
+    if kind == RULE_ZONE:
+        return _zone_kernel(spec['count'], spec['points'], spec['sigma'], spec['side'])
+    if kind == RULE_ONE_SIDE:
+        return _one_side_kernel(spec['points'])
+    if kind == RULE_TRENDING:
+        return _trending_kernel(spec['points'])
+    assert kind == RULE_ALTERNATING
+    return _alternating_kernel(spec['points'])
+
+# d2 of moving ranges of two points, sigma = mean moving range / D2
+D2 = 1.128
 # n         2      3      4      5      6      7      8      9      10
 A2 = [0, 0, 1.880, 1.023, 0.729, 0.577, 0.483, 0.419, 0.373, 0.337, 0.308]
 D3 = [0, 0, 0, 0, 0, 0, 0, 0.076, 0.136, 0.184, 0.223]
@@ -173,30 +389,77 @@ A3 = [0, 0, 2.659, 1.954, 1.628, 1.427, 1.287, 1.182, 1.099, 1.032,
       0.975, 0.927, 0.886, 0.850, 0.817, 0.789]  # 0.680, 0.606]
 
 
+# The get_stats_* functions of individual values and counts reduce along
+# axis 0, so a 2D array with one series per column (SpcColumns) gets arrays
+# of limits, one item per column. The limits from the reduced statistics are
+# shared with SpcIndex, where they come from prefix sums.
+
+def _mean_moving_range(data):
+    mr = np.diff(data, axis=0)
+    np.abs(mr, out=mr)
+    return np.mean(mr, axis=0)
+
+
+def _limits_x_mr_x(center, mr_bar):
+    return center, center - 3*mr_bar/D2, center + 3*mr_bar/D2
+
+
+def _limits_x_mr_mr(mr_bar):
+    lcl = 0 if np.ndim(mr_bar) == 0 else np.zeros_like(mr_bar)
+    return mr_bar, lcl, mr_bar + 3*mr_bar/D2
+
+
+def _limits_around(center, spread, factor):
+    """Limits of the x-bar charts: center -+ factor*spread."""
+    return center, center - factor*spread, center + factor*spread
+
+
+def _limits_scaled(center, lower, upper):
+    """Limits of the R and S charts: factors of the average range or deviation."""
+    return center, lower*center, upper*center
+
+
+def _limits_p(pbar, n):
+    sd = np.sqrt(pbar*(1-pbar)/n)
+    return pbar, np.maximum(pbar - 3*sd, 0), np.minimum(pbar + 3*sd, 1.0)
+
+
+def _limits_np(pbar, n):
+    sd = np.sqrt(n*pbar*(1-pbar))
+    center = n*pbar
+    return center, np.maximum(center - 3*sd, 0), np.minimum(center + 3*sd, n)
+
+
+def _limits_c(cbar):
+    return cbar, np.maximum(cbar - 3*np.sqrt(cbar), 0), cbar + 3*np.sqrt(cbar)
+
+
+def _limits_u(cbar, n):
+    return cbar, np.maximum(cbar - 3*np.sqrt(cbar/n), 0), cbar + 3*np.sqrt(cbar/n)
+
+
 def get_stats_x_mr_x(data, size):
     assert size == 1
-    center = np.mean(data)
-    sd = 0
-    for i in range(len(data)-1):
-        sd += abs(data[i] - data[i+1])
-    sd /= len(data) - 1
-    d2 = 1.128
-    lcl = center - 3*sd/d2
-    ucl = center + 3*sd/d2
-    return center, lcl, ucl
+    return _limits_x_mr_x(np.mean(data, axis=0), _mean_moving_range(data))
 
 
 def get_stats_x_mr_mr(data, size):
     assert size == 1
-    sd = 0
-    for i in range(len(data)-1):
-        sd += abs(data[i] - data[i+1])
-    sd /= len(data) - 1
-    d2 = 1.128
-    center = sd
-    lcl = 0
-    ucl = center + 3*sd/d2
-    return center, lcl, ucl
+    return _limits_x_mr_mr(_mean_moving_range(data))
+
+
+def _leading_zero(dtype, count, shape=()):
+    """Empty prepared series of count points after the leading 0 point, shape per point."""
+    data2 = np.empty((count + 1,) + shape, dtype=dtype)
+    data2[0] = 0
+    return data2
+
+
+def _subgroups(data, size):
+    """Subgroups as one 2D float array, without copying an ndarray already in that form."""
+    data = _as_float(data)
+    assert data.ndim == 2 and data.shape[1] == size
+    return data
 
 
 def get_stats_x_bar_r_x(data, size):
@@ -204,18 +467,9 @@ def get_stats_x_bar_r_x(data, size):
     assert n >= 2
     assert n <= 10
 
-    r_sum = 0
-    for xset in data:
-        assert len(xset) == n
-        r_sum += max(xset) - min(xset)
-    r_bar = r_sum / len(data)
-
-    x_bar = np.mean(data)
-
-    center = x_bar
-    lcl = center - A2[n]*r_bar
-    ucl = center + A2[n]*r_bar
-    return center, lcl, ucl
+    data = _subgroups(data, n)
+    r_bar = np.mean(np.ptp(data, axis=1))
+    return _limits_around(np.mean(data), r_bar, A2[n])
 
 
 def get_stats_x_bar_r_r(data, size):
@@ -223,16 +477,9 @@ def get_stats_x_bar_r_r(data, size):
     assert n >= 2
     assert n <= 10
 
-    r_sum = 0
-    for xset in data:
-        assert len(xset) == n
-        r_sum += max(xset) - min(xset)
-    r_bar = r_sum / len(data)
-
-    center = r_bar
-    lcl = D3[n]*r_bar
-    ucl = D4[n]*r_bar
-    return center, lcl, ucl
+    data = _subgroups(data, n)
+    r_bar = np.mean(np.ptp(data, axis=1))
+    return _limits_scaled(r_bar, D3[n], D4[n])
 
 
 def get_stats_x_bar_s_x(data, size):
@@ -240,13 +487,9 @@ def get_stats_x_bar_s_x(data, size):
     assert n >= 2
     assert n <= 10
 
+    data = _subgroups(data, n)
     s_bar = np.mean(np.std(data, 1, ddof=1))
-    x_bar = np.mean(data)
-
-    center = x_bar
-    lcl = center - A3[n]*s_bar
-    ucl = center + A3[n]*s_bar
-    return center, lcl, ucl
+    return _limits_around(np.mean(data), s_bar, A3[n])
 
 
 def get_stats_x_bar_s_s(data, size):
@@ -254,74 +497,109 @@ def get_stats_x_bar_s_s(data, size):
     assert n >= 2
     assert n <= 10
 
+    data = _subgroups(data, n)
     s_bar = np.mean(np.std(data, 1, ddof=1))
+    return _limits_scaled(s_bar, B3[n], B4[n])
 
-    center = s_bar
-    lcl = B3[n]*s_bar
-    ucl = B4[n]*s_bar
-    return center, lcl, ucl
 
+def get_stats_three_way(data, size):
+    """
+    I chart of the subgroup means, the first chart of a three-way (I-MR-R/S)
+    analysis: the limits come from the moving ranges between the means, so
+    the variation between subgroups counts as common cause. The means are one
+    reduction over the subgroup axis. See three_way_charts().
+    """
+    return get_stats_x_mr_x(prepare_data_x_bar_rs_x(data, size), 1)
 
-def get_stats_p(data, size):
-    n = size
-    assert n > 1
 
-    pbar = float(sum(data)) / (n * len(data))
-    sd = np.sqrt(pbar*(1-pbar)/n)
+def _elapsed(index):
+    """Timestamps, numbers or datetime64, as float seconds after the first one."""
+    t = np.asarray(index)
+    if t.dtype.kind == 'M':
+        return (t - t[0]) / np.timedelta64(1, 's')
+    t = np.asarray(t, dtype=float)
+    return t - t[0]
+
 
-    center = pbar
-    lcl = center - 3*sd
-    if lcl < 0:
-        lcl = 0
-    ucl = center + 3*sd
-    if ucl > 1:
-        ucl = 1.0
-    return center, lcl, ucl
+def get_stats_time_series(data, size, index=None):
+    """
+    Individuals chart of observations taken at irregular times (index). The
+    center is the time-weighted mean, a value stands for half the gaps to
+    its neighbours, the end points for the whole gap on their side. Sigma
+    comes from the moving ranges as in the X-mR chart. Equally spaced or
+    without index the limits are those of get_stats_x_mr_x.
+    """
+    assert size == 1
+    data = _as_float(data)
+    if index is None or len(data) < 2:
+        center = np.mean(data)
+    else:
+        t = _elapsed(index)
+        assert len(t) == len(data)
+        gaps = np.diff(t)
+        assert np.all(gaps >= 0) and t[-1] > 0
+        w = np.empty(len(t))
+        w[:-1] = gaps
+        w[-1] = gaps[-1]
+        w[1:] += gaps
+        w[0] += gaps[0]
+        center = np.dot(w, data) / np.sum(w)
+    return _limits_x_mr_x(center, _mean_moving_range(data))
 
 
-def get_stats_np(data, size):
-    n = size
-    assert n > 1
+# For p, np and u charts size may also be an array with the sample size of
+# every point, baseline and new data. The limits are then per-point arrays,
+# for p and u aligned with the leading 0 point of the prepared data.
 
-    pbar = float(sum(data)) / (n * len(data))
-    sd = np.sqrt(n*pbar*(1-pbar))
+def _sizes(size):
+    return np.asarray(size, dtype=float) if np.ndim(size) > 0 else size
 
-    center = n*pbar
-    lcl = center - 3*sd
-    if lcl < 0:
-        lcl = 0
-    ucl = center + 3*sd
-    if ucl > n:
-        ucl = n
-    return center, lcl, ucl
 
+def _total_size(size, count):
+    """Number of inspected units in the first count samples."""
+    if np.ndim(size) == 0:
+        return size * count
+    return np.sum(size[:count])
 
-def get_stats_c(data, size):
-    cbar = np.mean(data)
 
-    center = cbar
-    lcl = center - 3*np.sqrt(cbar)
-    if lcl < 0:
-        lcl = 0
-    ucl = center + 3*np.sqrt(cbar)
-    return center, lcl, ucl
+def _with_leading_point(limit, size):
+    """Per-point limits of per-point sizes get the leading point, others are kept."""
+    if np.ndim(size) == 0:
+        return limit
+    return np.concatenate((limit[:1], limit))
 
 
-def get_stats_u(data, size):
-    n = size
-    assert n > 1
+def get_stats_p(data, size):
+    n = _sizes(size)
+    assert np.all(n > 1)
+
+    pbar = np.sum(data, axis=0) / _total_size(n, len(data))
+    center, lcl, ucl = _limits_p(pbar, n)
+    return center, _with_leading_point(lcl, n), _with_leading_point(ucl, n)
 
-    cbar = float(sum(data))/(len(data)*n)
 
-    center = cbar
-    lcl = center - 3*np.sqrt(cbar/n)
-    if lcl < 0:
-        lcl = 0
-    ucl = center + 3*np.sqrt(cbar/n)
-    return center, lcl, ucl
+def get_stats_np(data, size):
+    n = _sizes(size)
+    assert np.all(n > 1)
+
+    pbar = np.sum(data, axis=0) / _total_size(n, len(data))
+    return _limits_np(pbar, n)
 
 
-def get_stats_cusum(data, size):
+def get_stats_c(data, size):
+    return _limits_c(np.mean(data, axis=0))
+
+
+def get_stats_u(data, size):
+    n = _sizes(size)
+    assert np.all(n > 1)
+
+    cbar = np.sum(data, axis=0) / _total_size(n, len(data))
+    center, lcl, ucl = _limits_u(cbar, n)
+    return center, _with_leading_point(lcl, n), _with_leading_point(ucl, n)
+
+
+def get_stats_cusum(data, size, target=None):
     """
     Find the data for a cusum graph
     Only returns 0 as the center as the data is moved
@@ -330,54 +608,100 @@ def get_stats_cusum(data, size):
     return 0, None, None
 
 
+def cusum_tabular_params(data, k=0.5, h=5, target=None, sigma=None):
+    r"""
+    Fill in the target and sigma of a tabular CUSUM from Phase I data.
+    $\mu_0$ defaults to the mean, $\sigma$ to the average moving range over D2.
+    """
+    data = _as_float(data)
+    if target is None:
+        target = np.mean(data)
+    if sigma is None:
+        sigma = _mean_moving_range(data) / D2
+    return {'k': k, 'h': h, 'target': target, 'sigma': sigma}
+
+
+def cusum_tabular(data, k=0.5, h=5, target=None, sigma=None, start=(0, 0)):
+    r"""
+    Tabular CUSUM
+    $C^+_i=\max(0, x_i-(\mu_0+K)+C^+_{i-1})$, $C^-_i=\max(0, (\mu_0-K)-x_i+C^-_{i-1})$
+    with $K=k\sigma$ and $C^\pm_0$ given by start (0, 0 for a new chart).
+    An alarm is raised when either side exceeds the decision interval $H=h\sigma$.
+    The recursion is evaluated in O(n) as the cumulative sum minus its running minimum.
+    Returns C+, C- and the indexes of data that raised an alarm.
+    """
+    data = _as_float(data)
+    p = cusum_tabular_params(data, k, h, target, sigma)
+    big_k = p['k'] * p['sigma']
+    big_h = p['h'] * p['sigma']
+    # in float64 and in place: S, then C = S - min(running min of S, 0),
+    # the running min is carried over blocks
+    c_plus = np.subtract(data, p['target'] + big_k, dtype=np.float64)
+    c_minus = np.subtract(p['target'] - big_k, data, dtype=np.float64)
+    for c, c0 in ((c_plus, start[0]), (c_minus, start[1])):
+        np.cumsum(c, out=c)
+        c += c0
+        low = 0.0
+        for pos in range(0, len(c), 65536):
+            part = c[pos:pos+65536]
+            running = np.minimum.accumulate(part)
+            np.minimum(running, low, out=running)
+            low = running[-1]
+            part -= running
+    alarms = np.flatnonzero((c_plus > big_h) | (c_minus > big_h))
+    return c_plus, c_minus, alarms
+
+
+def get_stats_cusum_tabular(data, size, k=0.5, h=5, target=None, sigma=None):
+    r"""
+    Find the limits of a tabular CUSUM graph
+    The center is 0 and the limits are the decision interval -H and H.
+    """
+    p = cusum_tabular_params(data, k, h, target, sigma)
+    big_h = p['h'] * p['sigma']
+    return 0, -big_h, big_h
+
+
 def prepare_data_none(data, size):
     return data
 
 
 def prepare_data_x_bar_rs_x(data, size):
-    data2 = []
-    for xset in data:
-        data2.append(np.mean(xset))
-    return data2
+    return np.mean(_subgroups(data, size), axis=1)
 
 
 def prepare_data_x_bar_r_r(data, size):
-    data2 = []
-    for xset in data:
-        data2.append(max(xset) - min(xset))
-    return data2
+    return np.ptp(_subgroups(data, size), axis=1)
 
 
 def prepare_data_x_bar_s_s(data, size):
-    data2 = []
-    for xset in data:
-        data2.append(np.std(xset, ddof=1))
-    return data2
+    return np.std(_subgroups(data, size), axis=1, ddof=1)
 
 
 def prepare_data_x_mr(data, size):
-    data2 = [0]
-    for i in range(len(data)-1):
-        data2.append(abs(data[i] - data[i+1]))
+    data = _as_float(data)
+    data2 = _leading_zero(data.dtype, max(len(data) - 1, 0), data.shape[1:])
+    np.subtract(data[1:], data[:-1], out=data2[1:])
+    np.abs(data2[1:], out=data2[1:])
     return data2
 
 
 def prepare_data_p(data, size):
-    data2 = [0]
-    for d in data:
-        data2.append(float(d)/size)
+    data = _as_float(data)
+    data2 = _leading_zero(data.dtype, len(data), data.shape[1:])
+    np.divide(data, _sizes(size), out=data2[1:])
     return data2
 
 
 def prepare_data_u(data, size):
-    data2 = [0]
-    for d in data:
-        data2.append(float(d)/size)
+    data = _as_float(data)
+    data2 = _leading_zero(data.dtype, len(data), data.shape[1:])
+    np.divide(data, _sizes(size), out=data2[1:])
     return data2
 
 
 def prepare_data_cusum(data, size, target=None):
-    """
+    r"""
     Prepares the data for a CUSUM graph
     subtracts the mean from each data point
     then calculates the culumative sum of each
@@ -386,13 +710,363 @@ def prepare_data_cusum(data, size, target=None):
     $\mu$ is the target value
     if $\mu is not provided the mean of the sample is used
     """
-    data2 = []
+    data = _as_float(data)
     if target is None:
         target = np.mean(data)
-    for d in data:
-        data2.append(float(d) - target)
-    data3 = [sum(data2[:i]) for i in range(len(data2)+1)]
-    return data3
+    data2 = _leading_zero(data.dtype, len(data))
+    _cusum(data, target, data2[1:])
+    return data2
+
+
+def _cusum(data, target, out, first=0.0, block=65536):
+    """
+    out[i] = first + sum of data[:i+1] - target. Summed in float64 block by
+    block, so float32 data keeps its precision without a float64 copy.
+    """
+    seg = np.empty(min(block, len(data)) + 1)
+    seg[0] = first
+    for k in range(0, len(data), block):
+        m = min(block, len(data) - k)
+        np.subtract(data[k:k+m], target, out=seg[1:m+1])
+        np.cumsum(seg[:m+1], out=seg[:m+1])
+        out[k:k+m] = seg[1:m+1]
+        seg[0] = seg[m]
+    return out
+
+
+def prepare_data_cusum_tabular(data, size, k=0.5, h=5, target=None, sigma=None):
+    r"""
+    Prepares the data for a tabular CUSUM graph
+    Each point is the larger of $C^+_i$ and $C^-_i$, the latter with a negative
+    sign, so a point is beyond -H or H exactly when the tabular CUSUM alarms.
+    Starts with $C_0=0$.
+    """
+    data = _as_float(data)
+    c_plus, c_minus, _ = cusum_tabular(data, k, h, target, sigma)
+    data2 = _leading_zero(data.dtype, len(data))
+    np.copyto(data2[1:], c_plus, casting='same_kind')
+    np.negative(c_minus, out=data2[1:], where=c_plus < c_minus, casting='same_kind')
+    return data2
+
+
+def ewma_params(data, lam=0.2, L=3, target=None, sigma=None):
+    r"""
+    Fill in the target and sigma of an EWMA chart from Phase I data.
+    $\mu_0$ defaults to the mean, $\sigma$ to the average moving range over D2.
+    """
+    data = _as_float(data)
+    if target is None:
+        target = np.mean(data)
+    if sigma is None:
+        sigma = _mean_moving_range(data) / D2
+    return {'lam': lam, 'L': L, 'target': target, 'sigma': sigma}
+
+
+def ewma(data, lam, start):
+    r"""
+    Exponentially weighted moving average $z_i=\lambda x_i+(1-\lambda)z_{i-1}$
+    with $z_0$=start, so a chunk can continue the EWMA of the previous one.
+    The recursion is evaluated as a linear filter in blocks: inside a block
+    z is a scaled cumulative sum, the blocks are joined by carrying z.
+    """
+    assert 0 < lam <= 1
+    a = 1.0 - lam
+    n = len(data)
+    if n == 0 or a == 0:
+        return (np.asarray(data, dtype=float) - start) * lam + start
+    # a**-block stays far from overflow, and the loop over blocks is short
+    block = int(min(4096, max(1, 50*np.log(10) / -np.log(a))))
+    blocks = -(-n // block)
+    # one float64 array, padded to whole blocks, worked on in place
+    z = np.zeros(blocks*block)
+    np.subtract(data, start, out=z[:n])
+    z = z.reshape(blocks, block)
+    powers = a ** np.arange(block)
+    z /= powers
+    np.cumsum(z, axis=1, out=z)
+    z *= lam * powers
+    carry = a * powers
+    if a ** block < 1e-17:
+        # nothing of a block reaches past the next one, so blocks join independently
+        last = z[:-1, -1].copy()
+        for k in range(0, blocks-1, 256):
+            z[k+1:k+257] += last[k:k+256, None] * carry
+    else:
+        last = 0.0
+        for k in range(blocks):
+            z[k] += carry * last
+            last = z[k, -1]
+    z = z.ravel()[:n]
+    z += start
+    return z
+
+
+def ewma_limits(params, first, count):
+    r"""
+    Time-varying EWMA limits of the points first .. first+count-1
+    $\mu_0 \pm L\sigma\sqrt{\frac{\lambda}{2-\lambda}(1-(1-\lambda)^{2i})}$
+    """
+    lam = params['lam']
+    sd = np.ones(count)
+    if lam < 1:
+        # (1-lambda)**2i is below float precision after the first points
+        early = min(count, max(0, int(np.log(1e-17) / (2*np.log(1-lam))) - first))
+        sd[:early] -= (1-lam) ** (2*np.arange(first+1, first+early+1))
+    # in place, the limits are the only full arrays
+    sd *= lam/(2-lam)
+    np.sqrt(sd, out=sd)
+    sd *= params['sigma']
+    sd *= params['L']
+    lcl = params['target'] - sd
+    sd += params['target']
+    return lcl, sd
+
+
+def get_stats_ewma(data, size, lam=0.2, L=3, target=None, sigma=None, count=None):
+    """
+    Find the limits of an EWMA graph
+    The center is the target, LCL and UCL are arrays with the exact limits
+    of every point; count is the number of points, len(data) by default.
+    """
+    p = ewma_params(data, lam, L, target, sigma)
+    if count is None:
+        count = len(data)
+    lcl, ucl = ewma_limits(p, 0, count)
+    return p['target'], lcl, ucl
+
+
+def prepare_data_ewma(data, size, lam=0.2, L=3, target=None, sigma=None):
+    """
+    Prepares the data for an EWMA graph, starting from $z_0$ = target.
+    """
+    data = _as_float(data)
+    p = ewma_params(data, lam, L, target, sigma)
+    # evaluated in float64, a**-block does not fit in float32
+    return ewma(data, lam, p['target']).astype(data.dtype, copy=False)
+
+
+# Multivariate charts of an (n, p) array, one column per process variable.
+# Mean and covariance come from the Phase I baseline, the covariance enters
+# through the inverse of its Cholesky factor, applied to all rows in blocks.
+
+def _betainc(a, b, x):
+    """Regularized incomplete beta function I_x(a, b), by its continued fraction."""
+    if x <= 0:
+        return 0.0
+    if x >= 1:
+        return 1.0
+    if x > (a+1) / (a+b+2):
+        return 1.0 - _betainc(b, a, 1.0-x)
+    front = math.exp(math.lgamma(a+b) - math.lgamma(a) - math.lgamma(b) + a*math.log(x) + b*math.log1p(-x))
+    tiny = 1e-300
+    c = 1.0
+    d = 1.0 - (a+b)*x/(a+1)
+    d = 1.0 / (d if abs(d) > tiny else tiny)
+    f = d
+    for m in range(1, 1000):
+        for num in (m*(b-m)*x / ((a+2*m-1)*(a+2*m)), -(a+m)*(a+b+m)*x / ((a+2*m)*(a+2*m+1))):
+            d = 1.0 + num*d
+            d = 1.0 / (d if abs(d) > tiny else tiny)
+            c = 1.0 + num/c
+            c = c if abs(c) > tiny else tiny
+            f *= c*d
+        if abs(c*d - 1.0) < 1e-15:
+            break
+    return front * f / a
+
+
+def _gammainc(a, x):
+    """Regularized lower incomplete gamma function P(a, x)."""
+    if x <= 0:
+        return 0.0
+    front = math.exp(a*math.log(x) - x - math.lgamma(a))
+    if x < a+1:
+        term = total = 1.0 / a
+        k = a
+        for _ in range(10000):
+            k += 1
+            term *= x / k
+            total += term
+            if term < total*1e-16:
+                break
+        return total * front
+    # continued fraction of Q(a, x)
+    tiny = 1e-300
+    b = x + 1.0 - a
+    c = 1.0 / tiny
+    d = 1.0 / b
+    f = d
+    for i in range(1, 10000):
+        num = -i*(i-a)
+        b += 2.0
+        d = num*d + b
+        d = 1.0 / (d if abs(d) > tiny else tiny)
+        c = b + num/c
+        c = c if abs(c) > tiny else tiny
+        f *= c*d
+        if abs(c*d - 1.0) < 1e-15:
+            break
+    return 1.0 - front*f
+
+
+def _quantile(cdf, q, hi):
+    """Point where the increasing cdf reaches q, by bisection from [0, hi]."""
+    while cdf(hi) < q:
+        hi *= 2
+    lo = 0.0
+    for _ in range(200):
+        mid = (lo + hi) / 2
+        if cdf(mid) < q:
+            lo = mid
+        else:
+            hi = mid
+        if hi - lo <= 1e-14*hi:
+            break
+    return (lo + hi) / 2
+
+
+def chi2_quantile(q, k):
+    """Quantile q of the chi-square distribution with k degrees of freedom"""
+    return _quantile(lambda x: _gammainc(k/2.0, x/2.0), q, 2.0*k + 10)
+
+
+def f_quantile(q, d1, d2):
+    """Quantile q of the F distribution with d1 and d2 degrees of freedom"""
+    x = _quantile(lambda x: _betainc(d1/2.0, d2/2.0, x), q, 1.0)
+    return d2*x / (d1*(1.0-x))
+
+
+def beta_quantile(q, a, b):
+    """Quantile q of the beta distribution"""
+    return _quantile(lambda x: _betainc(a, b, x), q, 1.0)
+
+
+def _whiten(cov):
+    """Inverse of the Cholesky factor L of cov, |W(x-mean)|^2 is the T^2 of x."""
+    chol = np.linalg.cholesky(np.atleast_2d(np.asarray(cov, dtype=float)))
+    return np.linalg.solve(chol, np.eye(len(chol)))
+
+
+def t2_params(data, alpha=0.0027, mean=None, cov=None):
+    """
+    Phase I estimates of a Hotelling T^2 chart: the mean and the inverse
+    Cholesky factor of the covariance of the baseline. With both mean and
+    cov given the parameters are known and count is None.
+    """
+    data = _as_float(data)
+    assert data.ndim == 2
+    count = None if mean is not None and cov is not None else len(data)
+    if mean is None:
+        mean = np.mean(data, axis=0)
+    if cov is None:
+        cov = np.cov(data, rowvar=False)
+    return {'mean': np.asarray(mean, dtype=float), 'whiten': _whiten(cov), 'alpha': alpha, 'count': count}
+
+
+def hotelling_t2(data, mean, whiten, block=65536):
+    r"""
+    $T^2 = (x-\bar{x})' S^{-1} (x-\bar{x})$ of every row of data (n, p), as
+    $|W(x-\bar{x})|^2$ with W the inverse Cholesky factor of S: one matrix
+    product per block of rows, no inversion per row.
+    """
+    data = _as_float(data)
+    t2 = np.empty(len(data))
+    for k in range(0, len(data), block):
+        y = np.subtract(data[k:k+block], mean, dtype=np.float64)
+        y = y.dot(whiten.T)
+        np.einsum('ij,ij->i', y, y, out=t2[k:k+block])
+    return t2
+
+
+def get_stats_t2(data, size, mean=None, whiten=None, alpha=0.0027, count=None):
+    """
+    Limits of a Hotelling T^2 chart for new observations (Phase II): the UCL
+    is the F quantile at 1-alpha for parameters estimated from count points,
+    the chi-square one for known parameters. LCL is 0 and the center the
+    median, so the run rules keep their false alarm rate; the zone rules
+    assume a symmetric distribution and do not apply.
+    """
+    p = size
+    if count is None:
+        return chi2_quantile(0.5, p), 0, chi2_quantile(1-alpha, p)
+    m = count
+    assert m > p
+    factor = p*(m+1)*(m-1) / float(m*(m-p))
+    return factor*f_quantile(0.5, p, m-p), 0, factor*f_quantile(1-alpha, p, m-p)
+
+
+def prepare_data_t2(data, size, mean=None, whiten=None, alpha=0.0027, count=None):
+    return hotelling_t2(data, mean, whiten)
+
+
+def t2_phase1(data, alpha=0.0027, max_iter=10):
+    """
+    Phase I screening of a baseline: the T^2 of every point against the beta
+    limit of the points used for the estimates, dropping the points beyond it
+    and estimating again until none is left. Returns the mask of the kept
+    rows, e.g. for Spc(data[keep], CHART_T2).
+    """
+    data = _as_float(data)
+    n, p = data.shape
+    keep = np.ones(n, dtype=bool)
+    for _ in range(max_iter):
+        m = int(np.sum(keep))
+        assert m > p + 1
+        params = t2_params(data[keep], alpha)
+        ucl = (m-1)**2 / float(m) * beta_quantile(1-alpha, p/2.0, (m-p-1)/2.0)
+        out = keep & (hotelling_t2(data, params['mean'], params['whiten']) > ucl)
+        if not np.any(out):
+            break
+        keep &= ~out
+    return keep
+
+
+def mewma_params(data, lam=0.1, h=None, alpha=0.0027, mean=None, cov=None):
+    """
+    Phase I estimates of a MEWMA chart, as t2_params(). h is the UCL, by
+    default the chi-square quantile at 1-alpha: with the exact covariance
+    every point is chi-square distributed, for a target ARL take h from
+    the MEWMA tables.
+    """
+    assert 0 < lam <= 1
+    params = t2_params(data, alpha, mean, cov)
+    if h is None:
+        h = chi2_quantile(1-alpha, len(params['mean']))
+    return {'mean': params['mean'], 'whiten': params['whiten'], 'lam': lam, 'h': h}
+
+
+def mewma(data, lam, mean, whiten, start=None, first=0):
+    r"""
+    MEWMA vectors $z_i=\lambda (x_i-\bar{x})+(1-\lambda)z_{i-1}$ of the rows of
+    data, from $z_0$ = start (0 by default), and their T^2 with the exact
+    covariance $\frac{\lambda}{2-\lambda}(1-(1-\lambda)^{2i})S$ of point i,
+    counted from first+1. Returns (T^2, last z) for the next chunk.
+    """
+    data = _as_float(data)
+    n, p = data.shape
+    if start is None:
+        start = np.zeros(p)
+    z = np.empty((n, p))
+    for j in range(p):
+        z[:, j] = ewma(data[:, j] - mean[j], lam, start[j])
+    t2 = hotelling_t2(z, 0.0, whiten)
+    scale = np.full(n, (2-lam) / lam)
+    if lam < 1:
+        early = min(n, max(0, int(np.log(1e-17) / (2*np.log(1-lam))) - first))
+        scale[:early] /= 1 - (1-lam) ** (2*np.arange(first+1, first+early+1))
+    t2 *= scale
+    last = z[-1].copy() if n > 0 else np.asarray(start, dtype=float)
+    return t2, last
+
+
+def get_stats_mewma(data, size, mean=None, whiten=None, lam=0.1, h=None):
+    """Limits of a MEWMA chart: the chi-square median as center, 0 as LCL and h as UCL."""
+    return chi2_quantile(0.5, size), 0, h
+
+
+def prepare_data_mewma(data, size, mean=None, whiten=None, lam=0.1, h=None):
+    return mewma(data, lam, mean, whiten)[0]
+
 
 STATS_FUNCS = {
     CHART_X_BAR_R_X: (get_stats_x_bar_r_x, prepare_data_x_bar_rs_x),
@@ -405,11 +1079,61 @@ STATS_FUNCS = {
     CHART_NP: (get_stats_np, prepare_data_none),
     CHART_C: (get_stats_c, prepare_data_none),  ##
     CHART_U: (get_stats_u, prepare_data_u),
-    CHART_EWMA: (None, prepare_data_none),
+    CHART_EWMA: (get_stats_ewma, prepare_data_ewma),
     CHART_CUSUM: (get_stats_cusum, prepare_data_cusum),
-    CHART_THREE_WAY: (None, prepare_data_none),
-    CHART_TIME_SERIES: (None, prepare_data_none)}
-
+    CHART_CUSUM_TABULAR: (get_stats_cusum_tabular, prepare_data_cusum_tabular),
+    CHART_THREE_WAY: (get_stats_three_way, prepare_data_x_bar_rs_x),
+    CHART_TIME_SERIES: (get_stats_time_series, prepare_data_none),
+    CHART_T2: (get_stats_t2, prepare_data_t2),
+    CHART_MEWMA: (get_stats_mewma, prepare_data_mewma)}
+
+# charts of SpcColumns, the same functions over a 2D array with one series
+# per column; the limits are arrays, one item per column
+STATS_FUNCS_COLUMNS = dict((ct, STATS_FUNCS[ct]) for ct in
+                           (CHART_X_MR_X, CHART_X_MR_MR, CHART_P, CHART_NP, CHART_C, CHART_U))
+
+# markers of get_chart_with_changepoints: rule -> (format, marker size, legend)
+CHANGEPOINT_CHART_MARKERS = {
+    RULES_7_ON_ONE_SIDE: ("kD", 10, 'Run of 7'),
+    RULES_8_ON_ONE_SIDE: ("yo", 10, 'Run of 8'),
+    RULES_9_ON_ONE_SIDE: ("ko", 10, 'Run of 9'),
+    RULES_2_OF_3_BEYOND_2SIGMA: ("go", 10, '2 of 3 Beyond 2 Sigma '),
+    RULES_4_OF_5_BEYOND_1SIGMA: ("co", 10, '4 of 5 Beyond 1 Sigma '),
+    RULES_15_BELOW_1SIGMA: ("mv", 10, '15 Below 1 Sigma '),
+    RULES_14_UP_DOWN: ("mo", 8, '14 Up and Down '),
+    RULES_6_TRENDING: ("cv", 10, '6 Trending'),
+    RULES_8_BEYOND_1SIGMA_BOTH_SIDES: ("kv", 10, '8 Beyond 1 Sigma on Both Sides'),
+    RULES_1_BEYOND_3SIGMA: ("ro", 10, 'Out of Limits')}
+# drawing order, points out of limits on top
+CHANGEPOINT_CHART_RULES = [RULES_7_ON_ONE_SIDE, RULES_8_ON_ONE_SIDE, RULES_9_ON_ONE_SIDE,
+                           RULES_2_OF_3_BEYOND_2SIGMA, RULES_4_OF_5_BEYOND_1SIGMA, RULES_15_BELOW_1SIGMA,
+                           RULES_14_UP_DOWN, RULES_6_TRENDING, RULES_8_BEYOND_1SIGMA_BOTH_SIDES,
+                           RULES_1_BEYOND_3SIGMA]
+CHANGEPOINT_CHART_LEGEND = [RULES_7_ON_ONE_SIDE, RULES_8_ON_ONE_SIDE, RULES_9_ON_ONE_SIDE,
+                            RULES_2_OF_3_BEYOND_2SIGMA, RULES_4_OF_5_BEYOND_1SIGMA, RULES_15_BELOW_1SIGMA,
+                            RULES_14_UP_DOWN, RULES_6_TRENDING, RULES_1_BEYOND_3SIGMA,
+                            RULES_8_BEYOND_1SIGMA_BOTH_SIDES]
+
+# charts of subgroups, their data is a 2D array (n_subgroups, size)
+SUBGROUP_CHARTS = (CHART_X_BAR_R_X, CHART_X_BAR_R_R, CHART_X_BAR_S_X, CHART_X_BAR_S_S, CHART_THREE_WAY)
+
+# charts that only some rules apply to: the tabular CUSUM signals when C+ or C-
+# passes the decision interval h, its run rules fire on in-control data
+CHART_RULES = {CHART_CUSUM_TABULAR: [RULES_1_BEYOND_3SIGMA]}
+
+# charts of several variables, their data is a 2D array (n_samples, n_variables)
+MULTIVARIATE_CHARTS = (CHART_T2, CHART_MEWMA)
+
+# charts whose limits SpcIndex computes from prefix sums
+INDEX_CHARTS = (CHART_X_BAR_R_X, CHART_X_BAR_R_R, CHART_X_BAR_S_X, CHART_X_BAR_S_S,
+                CHART_X_MR_X, CHART_X_MR_MR, CHART_P, CHART_NP, CHART_C, CHART_U,
+                CHART_CUSUM, CHART_CUSUM_TABULAR)
+
+# charts with limits over a trailing window of the data, see rolling_limits()
+ROLLING_CHARTS = (CHART_X_BAR_R_X, CHART_X_BAR_R_R, CHART_X_BAR_S_X, CHART_X_BAR_S_S,
+                  CHART_X_MR_X, CHART_X_MR_MR, CHART_P, CHART_NP, CHART_C, CHART_U)
+
+# reference implementations of the built-in rules, one window at a time
 RULES_FUNCS = {
     RULES_1_BEYOND_3SIGMA: (test_beyond_limits, 1),
     RULES_2_OF_3_BEYOND_2SIGMA: (test_beyond_2_sigma, 3),
@@ -422,6 +1146,645 @@ RULES_FUNCS = {
     RULES_15_BELOW_1SIGMA: (test_below_1_sigma, 15),
     RULES_8_BEYOND_1SIGMA_BOTH_SIDES: (test_beyond_1_sigma_both_sides, 8)}
 
+# every rule as a spec, compiled into RULES_MASKS; add rules with register_rule()
+RULES_SPECS = {
+    RULES_1_BEYOND_3SIGMA: rule_zone(1, 1, 3),
+    RULES_2_OF_3_BEYOND_2SIGMA: rule_zone(2, 3, 2),
+    RULES_4_OF_5_BEYOND_1SIGMA: rule_zone(4, 5, 1),
+    RULES_7_ON_ONE_SIDE: rule_one_side(7),
+    RULES_8_ON_ONE_SIDE: rule_one_side(8),
+    RULES_9_ON_ONE_SIDE: rule_one_side(9),
+    RULES_6_TRENDING: rule_trending(6),
+    RULES_14_UP_DOWN: rule_alternating(14),
+    RULES_15_BELOW_1SIGMA: rule_zone(15, 15, 1, SIDE_WITHIN),
+    RULES_8_BEYOND_1SIGMA_BOTH_SIDES: rule_zone(8, 8, 1, SIDE_EITHER)}
+
+RULES_MASKS = dict((name, compile_rule(spec)) for name, spec in RULES_SPECS.items())
+
+# built-in rules that only look at the center line and can run without LCL/UCL
+RULES_CENTER_ONLY = tuple(r for r, spec in RULES_SPECS.items() if spec['kind'] != RULE_ZONE)
+
+
+def register_rule(name, spec):
+    """
+    Add a rule from a spec, usable by name in the rules of every chart, in
+    batch and streaming checks, as fast as the built-in rules. Worker
+    processes see the rules registered at import time.
+    **Usage**
+    >>> RULES_3_OF_4_BEYOND_1_5SIGMA = register_rule("3 of 4 beyond 1.5*sigma", rule_zone(3, 4, 1.5))
+    >>> s = Spc(values, CHART_X_MR_X, rules=RULES_WECO + [RULES_3_OF_4_BEYOND_1_5SIGMA])
+    """
+    RULES_SPECS[name] = spec
+    RULES_MASKS[name] = compile_rule(spec)
+    return name
+
+
+def _rule_points(rule):
+    """Window length of a rule, no point before it is reported."""
+    return RULES_SPECS[rule]['points']
+
+
+def _needs_limits(rule):
+    return RULES_SPECS[rule]['kind'] == RULE_ZONE
+
+
+class Profiler(object):
+    """
+    Opt-in timing of the stages of Spc and spc_with_changepoints: wall time,
+    call count and points processed per stage and per rule. Spc records
+    'convert', 'hash' (with a cache), 'stats' and 'prepare'; rules are
+    evaluated when the violations are first asked for, which records 'zones'
+    once and one 'rule <name>' per rule. spc_with_changepoints records one
+    'segment' per segment around those, spc_with_detected_changepoints also
+    'detect'.
+    callback(stage, seconds, points) is called after every stage, e.g. to
+    send it to a metrics system. Without a profiler nothing is timed.
+    **Usage**
+    >>> p = Profiler()
+    >>> s = Spc(values, CHART_X_MR_X, rules=RULES_ALL, profiler=p)
+    >>> points = s.get_violating_points()
+    >>> p.report()
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        # stage -> [calls, seconds, points]
+        self.stages = {}
+
+    def stage(self, name, points=0):
+        """Context manager timing one run of a stage."""
+        return _ProfilerStage(self, name, points)
+
+    def record(self, name, seconds, points=0):
+        counters = self.stages.setdefault(name, [0, 0.0, 0])
+        counters[0] += 1
+        counters[1] += seconds
+        counters[2] += points
+        if self.callback is not None:
+            self.callback(name, seconds, points)
+
+    def report(self):
+        """Return one dict per stage, the slowest first."""
+        report = []
+        for name, (calls, seconds, points) in self.stages.items():
+            report.append({'stage': name, 'calls': calls, 'seconds': seconds, 'points': points,
+                           'points_per_sec': points / seconds if seconds > 0 else None})
+        report.sort(key=lambda r: -r['seconds'])
+        return report
+
+    def reset(self):
+        self.stages = {}
+
+
+class _ProfilerStage(object):
+
+    def __init__(self, profiler, name, points):
+        self.profiler = profiler
+        self.name = name
+        self.points = points
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, time.perf_counter() - self.start, self.points)
+        return False
+
+
+class _NoStage(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_STAGE = _NoStage()
+
+
+def _stage(profiler, name, points=0):
+    """Time a stage with the profiler, or do nothing when it is None."""
+    if profiler is None:
+        return _NO_STAGE
+    return profiler.stage(name, points)
+
+
+def find_violation_masks(data, center, lcl, ucl, rules, profiler=None):
+    """
+    Evaluate rules over the whole series at once.
+    Returns rule name -> boolean array, True at the last points of the
+    violating windows. Rules that need limits are left out without them.
+    """
+    with _stage(profiler, 'zones', len(data)):
+        zones = classify_zones(data, center, lcl, ucl)
+    masks = {}
+    for r in rules:
+        if r not in masks:
+            mask = rule_mask(zones, r, profiler)
+            if mask is not None:
+                masks[r] = mask
+    return masks
+
+
+def rule_mask(zones, rule, profiler=None):
+    """Mask of one rule over classify_zones() output, None when the rule needs missing limits."""
+    if not zones.limits and _needs_limits(rule):
+        return None
+    points_num = _rule_points(rule)
+    with _stage(profiler, 'rule ' + rule, len(zones['data'])):
+        mask = RULES_MASKS[rule](zones)
+    mask[:points_num] = False
+    return mask
+
+
+def _index_dtype(length):
+    return np.int32 if length < 2**31 else np.int64
+
+
+def _encode_points(idx, length, encoding=None, mask=None):
+    """
+    Encode the sorted indexes of one rule as 'index' (the indexes),
+    'runs' (starts and lengths of runs of consecutive points) or 'bits'
+    (a bit-packed mask of the series). None takes the smallest one, and no
+    indexes are stored as an empty 'index' unless 'bits' is asked for.
+    """
+    dtype = _index_dtype(length)
+    if len(idx) == 0 and encoding != 'bits':
+        return 'index', (np.zeros(0, dtype=dtype),), 0
+    options = {}
+    if encoding in (None, 'index'):
+        options['index'] = (idx.astype(dtype),)
+    if encoding in (None, 'runs'):
+        breaks = np.flatnonzero(np.diff(idx) != 1) + 1
+        starts = idx[np.concatenate(([0], breaks))]
+        ends = idx[np.concatenate((breaks-1, [len(idx)-1]))]
+        options['runs'] = (starts.astype(dtype), (ends-starts+1).astype(dtype))
+    if encoding == 'bits' or (encoding is None and length < len(idx)*8*np.dtype(dtype).itemsize):
+        if mask is None:
+            mask = np.zeros(length, dtype=bool)
+            mask[idx] = True
+        options['bits'] = (np.packbits(mask),)
+    name = min(options, key=lambda k: sum(a.nbytes for a in options[k]))
+    return name, options[name], len(idx)
+
+
+def _decode_points(stored, length, start=0, end=None):
+    """Indexes of one encoded rule in [start, end), as an array."""
+    name, arrays, count = stored
+    end = length if end is None else min(end, length)
+    start = max(start, 0)
+    if name == 'index':
+        idx = arrays[0]
+        return idx[np.searchsorted(idx, start):np.searchsorted(idx, end)]
+    if name == 'runs':
+        starts, lengths = arrays
+        first = max(np.searchsorted(starts, start, 'right')-1, 0)
+        last = np.searchsorted(starts, end)
+        starts = starts[first:last]
+        lengths = lengths[first:last]
+        offsets = np.cumsum(lengths) - lengths
+        idx = np.arange(lengths.sum(), dtype=starts.dtype) + np.repeat(starts - offsets.astype(starts.dtype), lengths)
+        return idx[(idx >= start) & (idx < end)]
+    first = start >> 3
+    bits = np.unpackbits(arrays[0][first:(end+7) >> 3])
+    idx = (np.flatnonzero(bits) + first*8).astype(_index_dtype(length))
+    return idx[(idx >= start) & (idx < end)]
+
+
+class Violations(object):
+    """
+    Rule violations of one series without a Python object per point.
+    The points of every rule are kept in the smallest of three encodings:
+    sorted int32 indexes, runs of consecutive points or a bit-packed mask,
+    so long runs of a continuously firing rule cost a few bytes.
+    Lookups are binary searches over the arrays.
+    get_violating_points() is the usual rule name -> list of indexes dict.
+    Rules given to defer() are evaluated on first use, one at a time.
+    **Usage**
+    >>> v = violations_from_masks({RULES_1_BEYOND_3SIGMA: np.arange(10) > 6}, RULES_BASIC)
+    >>> v.rules_at(8), v.counts(), v.between(0, 8)
+    (['1 beyond 3*sigma'], {'1 beyond 3*sigma': 3}, {'1 beyond 3*sigma': [7]})
+    """
+
+    def __init__(self, length=0, encoding=None):
+        assert encoding in (None, 'index', 'runs', 'bits')
+        self.length = length
+        self.encoding = encoding
+        # rules in the key order of get_violating_points(), and their repeats in the rules list
+        self.rules = []
+        self.repeats = {}
+        self._stored = {}
+        # points added by add() and not encoded yet
+        self._pending = {}
+        # rules not evaluated yet -> (position in the rules list, repeats)
+        self._deferred = {}
+        self._evaluate = None
+        # evaluated deferred rules -> (first violating index, position), their key order
+        self._order = {}
+
+    def defer(self, rules, evaluate):
+        """
+        Evaluate rules only when they are first asked for: evaluate(rule)
+        returns the sorted violating indexes of a rule, or None when it
+        cannot be checked. Every rule is evaluated at most once.
+        """
+        if len(rules) > 0:
+            self._evaluate = evaluate
+        for pos, r in enumerate(rules):
+            if r not in rules[:pos]:
+                self._deferred[r] = (pos, rules.count(r))
+
+    def _resolve(self, rule):
+        if rule not in self._deferred:
+            return
+        pos, repeat = self._deferred.pop(rule)
+        idx = self._evaluate(rule)
+        if len(self._deferred) == 0:
+            # let the evaluator free what it keeps for the next rules
+            self._evaluate = None
+        if idx is not None and len(idx) > 0:
+            self._order[rule] = (idx[0], pos)
+            self.set_points(rule, idx, repeat)
+
+    def _resolve_deferred(self):
+        for r in list(self._deferred):
+            self._resolve(r)
+        if self._order:
+            # first violation first, then rule order, before the rules added by add()
+            self.rules = sorted(self._order, key=self._order.get) + [r for r in self.rules if r not in self._order]
+            self._order = {}
+
+    def _resolve_all(self):
+        self._resolve_deferred()
+        self._flush()
+
+    def set_points(self, rule, idx, repeat=1, mask=None):
+        """Store the sorted violating indexes of a rule, replacing earlier ones."""
+        if rule not in self.rules:
+            self.rules.append(rule)
+        self.repeats[rule] = repeat
+        self._pending.pop(rule, None)
+        self._stored[rule] = _encode_points(np.asarray(idx, dtype=np.intp), self.length, self.encoding, mask)
+
+    def add(self, rule, i, repeat=1):
+        """
+        Add one violating point after all the stored ones, for streaming.
+        The points are encoded when a query needs them, or once as many
+        have been added as are stored, so adding costs amortized O(1).
+        """
+        if self._deferred or self._order:
+            self._resolve_deferred()
+        if rule not in self.rules:
+            self.rules.append(rule)
+            self.repeats[rule] = repeat
+        added = self._pending.setdefault(rule, [])
+        added.append(i)
+        self.length = max(self.length, i+1)
+        if len(added) >= 4096 and len(added) >= self._stored.get(rule, (None, None, 0))[2]:
+            self._flush([rule])
+
+    def _flush(self, rules=None):
+        if rules is None:
+            pending, self._pending = self._pending, {}
+        else:
+            pending = dict((r, self._pending.pop(r)) for r in rules if r in self._pending)
+        for r, added in pending.items():
+            idx = np.asarray(added, dtype=_index_dtype(self.length))
+            if r in self._stored:
+                idx = np.concatenate((_decode_points(self._stored[r], self.length), idx))
+            self._stored[r] = _encode_points(idx, self.length, self.encoding)
+
+    def points(self, rule):
+        """Return the violating indexes of a rule as an array, empty if it never fired."""
+        self._resolve(rule)
+        self._flush([rule])
+        if rule not in self._stored:
+            return np.zeros(0, dtype=_index_dtype(self.length))
+        return _decode_points(self._stored[rule], self.length)
+
+    def rules_at(self, i):
+        """Return the rules that fired at point i."""
+        self._resolve_all()
+        fired = []
+        for r in self.rules:
+            name, arrays, count = self._stored[r]
+            if name == 'index':
+                j = np.searchsorted(arrays[0], i)
+                hit = j < len(arrays[0]) and arrays[0][j] == i
+            elif name == 'runs':
+                j = np.searchsorted(arrays[0], i, 'right')-1
+                hit = j >= 0 and i < arrays[0][j] + arrays[1][j]
+            else:
+                hit = 0 <= i < self.length and (arrays[0][i >> 3] >> (7 - (i & 7))) & 1
+            if hit:
+                fired.append(r)
+        return fired
+
+    def counts(self):
+        """Return rule -> number of violating points."""
+        self._resolve_all()
+        return dict((r, self._stored[r][2]) for r in self.rules)
+
+    def between(self, start, end):
+        """Return rule -> list of violating indexes in [start, end), rules without any left out."""
+        self._resolve_all()
+        found = {}
+        for r in self.rules:
+            idx = _decode_points(self._stored[r], self.length, start, end)
+            if len(idx) > 0:
+                found[r] = idx.tolist()
+        return found
+
+    def nbytes(self):
+        """Return the memory of the encoded arrays in bytes."""
+        self._resolve_all()
+        return sum(a.nbytes for name, arrays, count in self._stored.values() for a in arrays)
+
+    def __contains__(self, rule):
+        self._resolve(rule)
+        return rule in self.repeats
+
+    def __getstate__(self):
+        # the evaluator is not picklable, evaluate what is left
+        self._resolve_all()
+        state = dict(self.__dict__)
+        state['_evaluate'] = None
+        return state
+
+    def get_violating_points(self):
+        """Return rule name -> list of indexes, like find_violating_points()."""
+        self._resolve_all()
+        points = {}
+        for r in self.rules:
+            idx = _decode_points(self._stored[r], self.length)
+            if self.repeats[r] > 1:
+                idx = np.repeat(idx, self.repeats[r])
+            points[r] = idx.tolist()
+        return points
+
+
+def violations_from_masks(masks, rules, encoding=None):
+    """Build Violations from rule masks of one series, with the key order of points_from_masks()."""
+    length = len(next(iter(masks.values()))) if masks else 0
+    violations = Violations(length, encoding)
+    violations.defer(rules, lambda r: np.flatnonzero(masks[r]) if r in masks else None)
+    violations._resolve_all()
+    return violations
+
+
+def points_from_masks(masks, rules):
+    """
+    Convert rule masks of one series to the rule name -> list of indexes dict,
+    with the key order and repeats of a point by point scan over rules.
+    """
+    return violations_from_masks(masks, rules, 'index').get_violating_points()
+
+
+def find_violating_points(data, center, lcl, ucl, rules):
+    """
+    Evaluate rules over the whole series at once.
+    Returns the same dict as checking every window with the test_* functions:
+    rule name -> list of indexes of the last points of the violating windows.
+    """
+    return points_from_masks(find_violation_masks(data, center, lcl, ucl, rules), rules)
+
+
+class RulesStream(object):
+    """
+    Incremental rule evaluation for monitoring. Every pushed point is checked
+    in constant time against fixed limits using small per-rule states: run
+    lengths on one side, trend lengths and k of m window counters.
+    It reports the same points as find_violating_points over the whole series.
+    """
+
+    def __init__(self, center, lcl, ucl, rules, start=0):
+        self.limits = lcl is not None and ucl is not None
+        self.rules = []
+        for r in rules:
+            if r not in self.rules and (self.limits or not _needs_limits(r)):
+                self.rules.append(r)
+        self.specs = [(r, RULES_SPECS[r]) for r in self.rules]
+        self.sigmas = set(spec['sigma'] for r, spec in self.specs if spec['kind'] == RULE_ZONE)
+        self.set_limits(center, lcl, ucl)
+        self.index = start - 1
+        self.prev = None
+        # deviation of prev from its own center, the center may vary per point
+        self.prev_dev = None
+        self.up = False
+        self.down = False
+        # lengths of the current runs of points without the given flag
+        self.runs = dict.fromkeys(('cross', 'not_up', 'not_down', 'same'), 0)
+        # k of m counters of zone rules: last m flags (a pair for the two sides) and their
+        # sums, or for m of m only the lengths of the current runs of flags
+        self.windows = {}
+        self.zone_rules = []
+        for r, spec in self.specs:
+            if spec['kind'] == RULE_ZONE:
+                window = None if spec['count'] == spec['points'] else deque(maxlen=spec['points'])
+                self.windows[r] = (window, [0, 0])
+                self.zone_rules.append((spec['sigma'], spec['side']) + self.windows[r])
+        # directions of the last pairs, the first one of a window sets the trend
+        self.pairs = deque(maxlen=max([spec['points']-1 for r, spec in self.specs
+                                       if spec['kind'] == RULE_TRENDING] + [1]))
+        # what push() looks at for every rule
+        self.checks = [(r, spec['kind'], spec['points'], spec.get('count'), self.windows.get(r, (None, None))[1])
+                       for r, spec in self.specs]
+
+    def set_limits(self, center, lcl, ucl):
+        """Change the limits for the next pushed points, for time-varying limits."""
+        self.center = center
+        self.lcl = lcl
+        self.ucl = ucl
+        if self.limits:
+            self.bounds = dict((sigma, _sigma_bounds(center, lcl, ucl, sigma)) for sigma in self.sigmas)
+
+    def _run(self, name, flag):
+        self.runs[name] = 0 if flag else self.runs[name] + 1
+
+    def push(self, x):
+        """Add one point, returns the list of rules violated at it."""
+        self.index += 1
+        i = self.index
+        prev = self.prev
+        dev = x - self.center
+        if prev is None:
+            cross = up = down = not_up = not_down = unordered = False
+        else:
+            cross = self.prev_dev*dev < 0
+            up = x > prev
+            down = x < prev
+            not_up = x <= prev
+            not_down = x >= prev
+            unordered = not up and not down and x != prev
+        same = (self.up and up) or (self.down and down)
+        self.prev = x
+        self.prev_dev = dev
+        self.up = up
+        self.down = down
+        self._run('cross', cross)
+        self._run('not_up', not_up)
+        self._run('not_down', not_down)
+        self._run('same', same)
+        self.pairs.append((up, down, unordered))
+        if self.limits:
+            center = self.center
+            bounds = self.bounds
+            for sigma, side, window, cnt in self.zone_rules:
+                upper, lower = bounds[sigma]
+                if side == SIDE_SAME:
+                    flags = (x > upper, x < lower)
+                elif side == SIDE_EITHER:
+                    flags = (not (x < upper and x > lower), False)
+                else:
+                    flags = (not ((x > upper and x > center) or (x < lower and x < center)), False)
+                if window is None:
+                    cnt[0] = cnt[0] + 1 if flags[0] else 0
+                    cnt[1] = cnt[1] + 1 if flags[1] else 0
+                    continue
+                if len(window) == window.maxlen:
+                    old = window[0]
+                    cnt[0] -= old[0]
+                    cnt[1] -= old[1]
+                window.append(flags)
+                cnt[0] += flags[0]
+                cnt[1] += flags[1]
+
+        fired = []
+        for r, kind, points_num, count, cnt in self.checks:
+            if i < points_num:
+                continue
+            if kind == RULE_ZONE:
+                hit = cnt[0] >= count or cnt[1] >= count
+            elif kind == RULE_ONE_SIDE:
+                hit = self.runs['cross'] >= points_num-1
+            elif kind == RULE_TRENDING:
+                if len(self.pairs) < points_num-1:
+                    continue
+                f_up, f_down, f_unordered = self.pairs[-(points_num-1)]
+                hit = ((f_up and self.runs['not_up'] >= points_num-2) or
+                       (f_down and self.runs['not_down'] >= points_num-2) or f_unordered)
+            else:
+                hit = self.runs['same'] >= points_num-2
+            if hit:
+                fired.append(r)
+        return fired
+
+
+def _limit_label(name, value):
+    if np.ndim(value) == 0:
+        return '%s (%0.3f)' % (name, value)
+    return '%s (per point)' % name
+
+
+def _limit_line(ax, x, y, label, **kwargs):
+    """Draw a limit: a horizontal line, or steps when there is a limit per point."""
+    if np.ndim(y) == 0:
+        ax.axhline(y, label=label, **kwargs)
+    else:
+        ax.step(x, np.broadcast_to(y, (len(x),)), where='mid', label=label, **kwargs)
+
+
+def _chart_readability(ax):
+    ax.spines["top"].set_visible(False)
+    ax.spines["right"].set_visible(False)
+    ax.get_xaxis().tick_bottom()
+    ax.get_yaxis().tick_left()
+    ax.tick_params(labelsize=14)
+    ax.grid(axis='y')
+    ylim = ax.get_ylim()
+    ax.set_ylim((ylim[0]-1, ylim[1]+1))
+
+
+def _hash_update(h, value):
+    if isinstance(value, np.ndarray):
+        h.update(('%s%s' % (value.dtype.str, value.shape)).encode())
+        h.update(np.ascontiguousarray(value).view(np.uint8).data)
+    elif isinstance(value, dict):
+        for k in sorted(value):
+            _hash_update(h, k)
+            _hash_update(h, value[k])
+    elif isinstance(value, (list, tuple)):
+        h.update(('%s%d' % (type(value).__name__, len(value))).encode())
+        for v in value:
+            _hash_update(h, v)
+    else:
+        h.update(repr(value).encode())
+
+
+class SpcCache(object):
+    """
+    LRU cache of Spc limits and prepared data, addressed by a hash of the
+    input values, chart type, size and parameters. Refreshing a chart over
+    an unchanged baseline skips the limits and the data preparation; only
+    hashing the input remains. Entries are evicted, least recently used
+    first, when their arrays exceed max_bytes.
+    **Usage**
+    >>> cache = SpcCache(max_bytes=256*2**20)
+    >>> s = Spc(baseline, CHART_X_BAR_R_X, cache=cache)
+    >>> s = Spc(baseline, CHART_X_BAR_R_X, cache=cache)
+    >>> cache.stats()
+    {'hits': 1, 'misses': 1, 'evictions': 0, 'entries': 1, 'bytes': 8000}
+    """
+
+    def __init__(self, max_bytes=256*2**20):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, alldata, count, chart_type, size, chart_params, stats_custom, window=None, index=None):
+        """Content hash of everything the limits and prepared data depend on."""
+        h = hashlib.sha256()
+        values = alldata if isinstance(alldata, np.ndarray) else np.asarray(alldata, dtype=float)
+        _hash_update(h, values)
+        _hash_update(h, (count, chart_type, size, chart_params, stats_custom, window, index))
+        return h.digest()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, entry):
+        # the cache owns read-only copies, so neither the caller nor a Spc can change them
+        entry = dict(entry)
+        entry['data'] = self._frozen(entry['data'])
+        entry['stats'] = tuple(v if np.ndim(v) == 0 else self._frozen(v) for v in entry['stats'])
+        nbytes = entry['data'].nbytes + sum(np.asarray(v).nbytes for v in entry['stats'] if v is not None)
+        if nbytes > self.max_bytes or key in self.entries:
+            return
+        self.entries[key] = (entry, nbytes)
+        self.bytes += nbytes
+        while self.bytes > self.max_bytes:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.bytes -= evicted
+            self.evictions += 1
+
+    @staticmethod
+    def _frozen(values):
+        values = np.array(values)
+        if values.dtype.kind != 'f':
+            values = values.astype(float)
+        values.setflags(write=False)
+        return values
+
+    def stats(self):
+        """Return hits, misses, evictions, number of entries and bytes held."""
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self.entries), 'bytes': self.bytes}
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
 
 # noinspection PyUnresolvedReferences
 class Spc(object):
@@ -431,6 +1794,13 @@ class Spc(object):
     :arguments:
       data
        user data as flat array
+      window
+       rolling limits: every point is checked against the limits of the
+       window points before it (see rolling_limits()), also the points
+       added later by append() and monitor()
+      index
+       timestamps of data and newdata, numbers or datetime64: the x axis
+       of get_chart() and the time weights of CHART_TIME_SERIES
     **Usage**
     >>> s = Spc([1, 2, 3, 3, 2, 1, 3, 8], CHART_X_MR_X)
     >>> s.get_stats()
@@ -442,35 +1812,150 @@ class Spc(object):
     >>> s.get_stats()
     (0, None, None)
     >>> s.get_violating_points()
-    {'7 on one side': [7, 8], '1 beyond 3*sigma': [1, 2, 3, 4, 5, 6, 7, 8]}
+    {'7 on one side': [7, 8]}
     >>> s.get_chart()
+    >>> s = Spc([1, 2, 3, 3, 2, 1, 3, 8], CHART_CUSUM_TABULAR, chart_params={'k': 0.5, 'h': 1})
+    >>> s.get_violating_points()
+    {'1 beyond 3*sigma': [8]}
     """
 
-    def __init__(self, data, chart_type, rules=RULES_BASIC, stats_custom=None, newdata=None, sizes=None):
-        data = data if isinstance(data, list) else list(data)
+    def __init__(self, data, chart_type, rules=RULES_BASIC, stats_custom=None, newdata=None, sizes=None,
+                 chart_params=None, profiler=None, cache=None, dtype=None, window=None,
+                 index=None):
+        # the data is one float array (subgroups 2D), with no Python object per item;
+        # floating ndarrays, views and memory-mapped files are used without a copy.
+        # dtype=np.float32 halves the memory, by default float32 input stays float32
+        if not hasattr(data, '__len__'):
+            # generators and other iterables are read once
+            data = list(data)
+        with _stage(profiler, 'convert', len(data)):
+            data = _as_float(data, dtype)
+        self.dtype = data.dtype
+        self.profiler = profiler
         self.chart_type = chart_type
+        if chart_type in CHART_RULES:
+            rules = [r for r in rules if r in CHART_RULES[chart_type]]
         self.rules = rules
+        self.window = window
         self.stats = []
         if newdata is None:
             newdata = []
+        elif not hasattr(newdata, '__len__'):
+            newdata = list(newdata)
 
-        sf, pd = STATS_FUNCS[chart_type]
         if sizes is None:
-            if isinstance(data[0], (list, tuple, np.ndarray)):
-                size = len(data[0])
-            else:
-                size = 1
+            size = data.shape[1] if data.ndim == 2 else 1
         else:
             size = sizes
-        if stats_custom is None and chart_type not in (CHART_EWMA, CHART_THREE_WAY,CHART_TIME_SERIES):
-            self.center, self.lcl, self.ucl = sf(data, size)
-        elif chart_type not in (CHART_EWMA, CHART_THREE_WAY,CHART_TIME_SERIES):
-            self.center, self.lcl, self.ucl = stats_custom
-#        else:
-#            self.center, self.lcl, self.ucl =  0, 0, 0
-
-        self._data = pd(data + newdata, size)
-        self.violating_points = self._find_violating_points()
+        if len(newdata) > 0:
+            alldata = np.concatenate((data, np.asarray(newdata, dtype=self.dtype).reshape((-1,) + data.shape[1:])))
+        else:
+            alldata = data
+        self.size = size
+        self.index = None if index is None else np.asarray(index)
+        if index is not None:
+            assert len(self.index) == len(alldata)
+
+        # limits, prepared data and carried state, from the cache when the input was seen before
+        entry = None
+        if cache is not None:
+            with _stage(profiler, 'hash', len(alldata)):
+                key = cache.key(alldata, len(data), chart_type, size, chart_params, stats_custom, window,
+                                self.index)
+            entry = cache.get(key)
+        if entry is None:
+            entry = self._compute(data, alldata, chart_params, stats_custom)
+            if cache is not None:
+                cache.put(key, entry)
+        self.chart_params = dict(entry['params'])
+        self.center, self.lcl, self.ucl = entry['stats']
+        self._data = entry['data']
+        self.violations = self._find_violations()
+        # points of rules outside self.rules, asked for by _find_violating_points()
+        self._other_points = {}
+
+        # state carried over to the points added later by append()
+        self._pending = []
+        self._stream = None
+        self._carry = dict(entry['carry'])
+        # buffers of the arrays appended to by update(), see _append()
+        self._buffers = {}
+
+    def _compute(self, data, alldata, chart_params, stats_custom):
+        chart_type = self.chart_type
+        size = self.size
+        profiler = self.profiler
+        sf, pd = STATS_FUNCS[chart_type]
+        params = {} if chart_params is None else dict(chart_params)
+        if chart_type == CHART_CUSUM_TABULAR:
+            # target and sigma come from the baseline, not from the new data
+            params = cusum_tabular_params(data, **params)
+        elif chart_type == CHART_EWMA:
+            params = ewma_params(data, **params)
+        elif chart_type == CHART_T2:
+            params = t2_params(data, **params)
+        elif chart_type == CHART_MEWMA:
+            params = mewma_params(data, **params)
+        if chart_type == CHART_CUSUM:
+            # keep the target fixed for the points added later by append()
+            params.setdefault('target', np.mean(alldata))
+        stats = None, None, None
+        with _stage(profiler, 'stats', len(data)):
+            if self.window is not None:
+                # per-point limits over the trailing window, including newdata
+                assert stats_custom is None
+                rolling = SpcIndex(alldata, chart_type, sizes=size)
+                stats = rolling.get_rolling_stats(self.window)
+            elif stats_custom is None and chart_type == CHART_EWMA:
+                # time-varying limits, one for every point including newdata
+                stats = sf(data, size, count=len(alldata), **params)
+            elif stats_custom is None and chart_type == CHART_TIME_SERIES:
+                # the time weights of the baseline points
+                index = None if self.index is None else self.index[:len(data)]
+                stats = sf(data, size, index=index, **params)
+            elif stats_custom is None:
+                stats = sf(data, size, **params)
+            else:
+                stats = stats_custom
+
+        carry = {}
+        with _stage(profiler, 'prepare', len(alldata)):
+            if chart_type == CHART_MEWMA:
+                # the last MEWMA vector and the point count continue in the points added later
+                prepared, carry['mewma'] = mewma(alldata, params['lam'], params['mean'], params['whiten'])
+                carry['count'] = len(alldata)
+            else:
+                prepared = pd(alldata, size, **params)
+            prepared = np.ascontiguousarray(prepared, dtype=self.dtype)
+        carry['last'] = alldata[-1]
+        if chart_type == CHART_CUSUM_TABULAR:
+            c_plus, c_minus, _ = cusum_tabular(alldata, **params)
+            carry['cusum'] = (c_plus[-1], c_minus[-1])
+        if self.window is not None:
+            # the raw points the limits of the next points come from, and the
+            # prefix sums before them
+            carry['window'] = np.array(alldata[-self.window:])
+            carry['prefix'] = rolling.prefix_state(len(alldata) - self.window)
+        return {'params': params, 'stats': tuple(stats), 'data': prepared, 'carry': carry}
+
+    def _rule_evaluator(self):
+        # indexes of one rule over the current data, the zones are computed once and shared
+        data, center, lcl, ucl, profiler = self._data, self.center, self.lcl, self.ucl, self.profiler
+        zones = []
+
+        def evaluate(rule):
+            if not zones:
+                with _stage(profiler, 'zones', len(data)):
+                    zones.append(classify_zones(data, center, lcl, ucl))
+            mask = rule_mask(zones[0], rule, profiler)
+            return None if mask is None else np.flatnonzero(mask)
+        return evaluate
+
+    def _find_violations(self):
+        # rules are evaluated on first use
+        violations = Violations(len(self._data))
+        violations.defer(list(self.rules), self._rule_evaluator())
+        return violations
 
     def _find_violating_points(self, rules=None):
         if rules is None:
@@ -479,314 +1964,1243 @@ class Spc(object):
             rs = rules
         else:
             rs = self.rules
-        points = {}
-        for i in range(len(self._data)):
-            for r in rs:
-                func, points_num = RULES_FUNCS[r]
-                if func is None or i <= points_num - 1:
-                    continue
-                if func(self._data[i-points_num+1:i+1], self.center, self.lcl, self.ucl):
-                    points.setdefault(r, []).append(i)
-        return points
-
-    def get_chart(self, legend=True, title=None, index=None):
-        """Generate chart using matplotlib."""
+        # the rules of the chart come from its violations, others are evaluated once and kept
+        evaluate = self._rule_evaluator()
+
+        def points(rule):
+            if rule in self.rules:
+                return self.violations.points(rule)
+            if rule not in self._other_points:
+                self._other_points[rule] = evaluate(rule)
+            return self._other_points[rule]
+
+        found = Violations(len(self._data))
+        found.defer(list(rs), points)
+        return found.get_violating_points()
+
+    @property
+    def violating_points(self):
+        """rule name -> list of indexes, built from the compact violations on every access"""
+        return self.violations.get_violating_points()
+
+    def append(self, values):
+        """
+        Queue new observations (flat values or subgroups, like newdata).
+        They are checked against the current limits by update().
+        """
+        self._pending.extend(values)
+
+    def update(self):
+        """
+        Check the observations queued by append() against the fixed limits.
+        Each new point is evaluated in constant time, the limits are not
+        recomputed. Returns only the new violating points, in the same form
+        as get_violating_points(), and adds them to violations.
+        """
+        values, self._pending = self._pending, []
+        if len(values) == 0:
+            return {}
+        with _stage(self.profiler, 'update', len(values)):
+            return self._update_stream(values)
+
+    def _update_stream(self, values):
+        new = {}
+        # per-point limits would need the sample sizes of the new points
+        assert np.ndim(self.size) == 0
+        self._other_points = {}
+        if self._stream is None:
+            # the deferred rules look at the data before the new points
+            self.violations._resolve_deferred()
+            self._start_stream()
+        values = _as_float(values, self.dtype)
+        data2 = self._prepare_new(values, self._data[-1], self._carry)
+        start = len(self._data)
+        per_point = np.ndim(self.lcl) > 0
+        if per_point:
+            self._extend_limits(start, values)
+        for i, x in enumerate(data2.tolist(), start):
+            if per_point:
+                self._stream.set_limits(*self._limits_at(i))
+            fired = self._stream.push(x)
+            if fired:
+                # iterate self.rules to keep the order and repeats of the batch scan
+                for r in self.rules:
+                    if r in fired:
+                        new.setdefault(r, []).append(i)
+                for r in fired:
+                    self.violations.add(r, i, self.rules.count(r))
+        self._append('_data', data2)
+        self.violations.length = len(self._data)
+        return new
+
+    def _start_stream(self):
+        # only the last points matter for the rule states, the longest rule has 15
+        tail = max([_rule_points(r) for r in self.rules] + [1]) + 2
+        start = max(len(self._data) - tail, 0)
+        per_point = np.ndim(self.lcl) > 0
+        self._stream = RulesStream(*(self._limits_at(start) if per_point else self.get_stats()),
+                                   rules=self.rules, start=start)
+        for i in range(start, len(self._data)):
+            if per_point:
+                self._stream.set_limits(*self._limits_at(i))
+            self._stream.push(float(self._data[i]))
+
+    def _limits_at(self, i):
+        return tuple(v if np.ndim(v) == 0 else v[i] for v in self.get_stats())
+
+    def _extend_limits(self, first, values):
+        # EWMA limits depend on the index alone, rolling ones on the window before each point
+        if self.window is not None:
+            center, lcl, ucl = self._rolling_new(values, self._carry)
+            self._append('center', center)
+        else:
+            assert self.chart_type == CHART_EWMA
+            lcl, ucl = ewma_limits(self.chart_params, first, len(values))
+        self._append('lcl', lcl)
+        self._append('ucl', ucl)
+
+    def _append(self, name, values):
+        # the series grows in a buffer that doubles when full, the attribute is a view of it
+        current = getattr(self, name)
+        n, k = len(current), len(values)
+        buf = self._buffers.get(name)
+        if buf is None or len(buf) < n + k:
+            buf = np.empty((max(2*n, n + k, 16),) + current.shape[1:], dtype=current.dtype)
+            buf[:n] = current
+            self._buffers[name] = buf
+        buf[n:n+k] = values
+        setattr(self, name, buf[:n+k])
+
+    def _rolling_new(self, values, carry):
+        # rolling limits of new raw points, from the window carried before them
+        raw = np.concatenate((carry['window'], values))
+        index = SpcIndex(raw, self.chart_type, sizes=self.size, state=carry['prefix'])
+        carry['window'] = raw[-self.window:]
+        carry['prefix'] = index.prefix_state(len(raw) - self.window)
+        return tuple(v[-len(values):] for v in index.get_rolling_stats(self.window))
+
+    def _prepare_new(self, values, last, carry):
+        # last is the last prepared point, carry the state of the raw series, updated here
+        sf, pd = STATS_FUNCS[self.chart_type]
+        params = self.chart_params
+        values = _as_float(values, self.dtype)
+        if pd is prepare_data_x_mr:
+            data2 = pd(np.concatenate(([carry['last']], values)), self.size)[1:]
+        elif pd in (prepare_data_p, prepare_data_u):
+            data2 = pd(values, self.size)[1:]
+        elif pd is prepare_data_cusum:
+            data2 = _cusum(values, params['target'], np.empty(len(values)), last)
+        elif pd is prepare_data_ewma:
+            data2 = ewma(values, params['lam'], last)
+        elif pd is prepare_data_mewma:
+            data2, carry['mewma'] = mewma(values, params['lam'], params['mean'], params['whiten'],
+                                          carry['mewma'], carry['count'])
+            carry['count'] += len(values)
+        elif pd is prepare_data_cusum_tabular:
+            c_plus, c_minus, _ = cusum_tabular(values, start=carry['cusum'], **params)
+            carry['cusum'] = (c_plus[-1], c_minus[-1])
+            data2 = np.where(c_plus >= c_minus, c_plus, -c_minus)
+        else:
+            data2 = pd(values, self.size, **params)
+        carry['last'] = values[-1]
+        return np.asarray(data2, dtype=self.dtype)
+
+    def monitor(self, chunks):
+        """
+        Phase II over data that does not fit in memory: check chunks of new
+        observations (flat values or subgroups, like newdata) against the
+        limits of this chart, every chunk in one vectorized pass. The chunk
+        data is not kept. The last points of a chunk are carried over to the
+        next one, so runs and trends across chunk boundaries are found.
+        Indexes continue after the data, like update(); the chart itself is
+        not changed.
+        Yields (start, end, points) for every chunk, points in the same form
+        as get_violating_points().
+        """
+        checker = SpcChecker(self)
+        for values in chunks:
+            if len(values) > 0:
+                yield checker.check(values)
+
+    def get_chart(self, legend=True, title=None, index=None, figure=None):
+        """
+        Generate chart using matplotlib.
+        figure: draw into this figure instead of a new pyplot one, e.g. one
+        from chart_figure() reused for many charts in headless mode.
+        """
+        with _stage(self.profiler, 'chart', len(self._data)):
+            return self._get_chart(legend, title, index, figure)
+
+    def _get_chart(self, legend, title, index, figure):
         try:
             import matplotlib
         except ImportError:
             raise Exception("matplotlib not installed")
         else:
             import matplotlib.pyplot as plt
-            import matplotlib.lines as mlines
-
-        if index is not None and not isinstance(index, list):
-            index = list(index)
-
-        plt.figure(figsize=(20, 10))
-        ax = plt.subplot(111)
 
-        if index is None:
-            plt.plot(self._data, "bo-", ms=5, label='Data')
+        if figure is None:
+            plt.figure(figsize=(20, 10))
+            ax = plt.subplot(111)
         else:
-            plt.plot(index, self._data, "bo-", ms=5, label='Data')
+            figure.clear()
+            ax = figure.add_subplot(111)
+
+        data = np.asarray(self._data, dtype=float)
+        if index is None and self.index is not None and len(self.index) == len(data):
+            index = self.index
+        x = np.arange(len(data)) if index is None else np.asarray(index)
+        ax.plot(x, data, "bo-", ms=5, label='Data')
 
         title = self.chart_type if title is None else title
-        plt.title(title, fontsize=22)  # setting the title for the figure
+        ax.set_title(title, fontsize=22)  # setting the title for the figure
         if self.center is not None:
-            plt.axhline(self.center, color='k', linestyle='-', label='Center (%0.3f)' % self.center)
+            _limit_line(ax, x, self.center, _limit_label('Center', self.center), color='k', linestyle='-')
         if self.ucl is not None:
-            plt.axhline(self.ucl, color='r', linestyle='-.', linewidth=4, label='UCL (%0.3f)' % self.ucl)
-            plt.axhline(self.center+(self.ucl-self.center)/3, color='r', linestyle=':', linewidth=2, label='UCL (%0.3f)' % self.ucl)
-            plt.axhline(self.center+(self.ucl-self.center)*2/3, color='r', linestyle=':', linewidth=2, label='UCL (%0.3f)' % self.ucl)
+            ucl_label = _limit_label('UCL', self.ucl)
+            _limit_line(ax, x, self.ucl, ucl_label, color='r', linestyle='-.', linewidth=4)
+            _limit_line(ax, x, self.center+(self.ucl-self.center)/3, ucl_label, color='r', linestyle=':', linewidth=2)
+            _limit_line(ax, x, self.center+(self.ucl-self.center)*2/3, ucl_label, color='r', linestyle=':', linewidth=2)
         if self.lcl is not None:
-            plt.axhline(self.lcl, color='r', linestyle='-.', linewidth=4, label='LCL (%0.3f)' % self.lcl)
-            plt.axhline(self.center-(self.center-self.lcl)/3, color='r', linestyle=':', linewidth=2, label='UCL (%0.3f)' % self.ucl)
-            plt.axhline(self.center-(self.center-self.lcl)*2/3, color='r', linestyle=':', linewidth=2, label='UCL (%0.3f)' % self.ucl)
-
-        if RULES_7_ON_ONE_SIDE in self.violating_points:
-            for i in self.violating_points[RULES_7_ON_ONE_SIDE]:
-                if index is not None:
-                    ax.plot([index[i]], [self._data[i]], "yo", ms=10)
-                else:
-                    ax.plot([i], [self._data[i]], "yo", ms=10)
-            ax.plot([], [], color='yellow', linestyle='', marker='o', ms=10, label='Run of 7')
+            _limit_line(ax, x, self.lcl, _limit_label('LCL', self.lcl), color='r', linestyle='-.', linewidth=4)
+            ucl_label = _limit_label('UCL', self.ucl)
+            _limit_line(ax, x, self.center-(self.center-self.lcl)/3, ucl_label, color='r', linestyle=':', linewidth=2)
+            _limit_line(ax, x, self.center-(self.center-self.lcl)*2/3, ucl_label, color='r', linestyle=':', linewidth=2)
 
-        if RULES_8_ON_ONE_SIDE in self.violating_points:
-            for i in self.violating_points[RULES_8_ON_ONE_SIDE]:
-                if index is not None:
-                    ax.plot([index[i]], [self._data[i]], "yo", ms=10)
-                else:
-                    ax.plot([i], [self._data[i]], "yo", ms=10)
-            ax.plot([], [], color='yellow', linestyle='', marker='o', ms=10, label='Run of 8')
+        # all the points of a rule are drawn as one line of markers
+        for r, fmt, label in ((RULES_7_ON_ONE_SIDE, "yo", 'Run of 7'),
+                              (RULES_8_ON_ONE_SIDE, "yo", 'Run of 8'),
+                              (RULES_1_BEYOND_3SIGMA, "ro", 'Out of Limits')):
+            if r in self.violations:
+                idx = self.violations.points(r)
+                ax.plot(x[idx], data[idx], fmt, ms=10, linestyle='', label=label)
 
-        if RULES_1_BEYOND_3SIGMA in self.violating_points:
-            for i in self.violating_points[RULES_1_BEYOND_3SIGMA]:
-                if index is not None:
-                    ax.plot([index[i]], [self._data[i]], "ro", ms=10)
-                else:
-                    ax.plot([i], [self._data[i]], "ro", ms=10)
-            ax.plot([], [], color='red', linestyle='', marker='o', ms=10, label='Out of Limits')
-
-        # readability improvements
-        ax.spines["top"].set_visible(False)
-        ax.spines["right"].set_visible(False)
-        ax.get_xaxis().tick_bottom()
-        ax.get_yaxis().tick_left()
-        plt.xticks(fontsize=14)
-        plt.yticks(fontsize=14)
-        plt.grid(axis='y')
-        ylim = plt.ylim()
-        plt.ylim((ylim[0]-1, ylim[1]+1))
+        _chart_readability(ax)
 
         legend_output = None
         if legend is True:
-            legend_output = plt.legend(bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0.)
+            legend_output = ax.legend(bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0.)
         return ax, legend_output
 
     def get_violating_points(self):
         """Return points that violates rules of control chart"""
-        return self.violating_points
+        return self.violations.get_violating_points()
+
+    def get_violations(self):
+        """Return the violations as a compact Violations object"""
+        return self.violations
 
     def get_stats(self):
         """Return basic statistics about data as tuple: (center, LCL, UCL)."""
         return self.center, self.lcl, self.ucl
 
 
+class SpcColumns(object):
+    """
+    SPC analysis of many series at once. Takes a 2D array with one series
+    per column, (n_samples, n_series), and computes the limits and rule
+    violations of all columns in one vectorized pass.
+    Supported charts are the ones in STATS_FUNCS_COLUMNS.
+    **Usage**
+    >>> s = SpcColumns(np.array([[1, 5], [2, 5], [3, 6], [3, 5], [2, 4], [1, 5], [3, 6], [8, 5]]), CHART_X_MR_X)
+    >>> s.get_violating_points(0)
+    {'1 beyond 3*sigma': [7]}
+    """
+
+    def __init__(self, data, chart_type, rules=RULES_BASIC, stats_custom=None, newdata=None, sizes=None):
+        data = np.asarray(data, dtype=float)
+        assert data.ndim == 2
+        self.chart_type = chart_type
+        self.rules = rules
+        size = 1 if sizes is None else sizes
+
+        sf, pd = STATS_FUNCS_COLUMNS[chart_type]
+        if stats_custom is None:
+            self.center, self.lcl, self.ucl = sf(data, size)
+        else:
+            self.center, self.lcl, self.ucl = [np.broadcast_to(np.asarray(v, dtype=float), data.shape[1:])
+                                               for v in stats_custom]
+        if newdata is not None:
+            data = np.concatenate((data, np.asarray(newdata, dtype=float)))
+        self._data = pd(data, size)
+        self.masks = self._find_violation_masks()
+
+    def _find_violation_masks(self, rules=None):
+        rs = rules if rules else self.rules
+        return find_violation_masks(self._data, self.center, self.lcl, self.ucl, rs)
+
+    def get_violation_masks(self):
+        """Return rule -> boolean array (n_samples, n_series) of violating points"""
+        return self.masks
+
+    def get_violating_points(self, column):
+        """Return points of one column that violate rules, like Spc.get_violating_points()"""
+        return points_from_masks(dict((r, m[:, column]) for r, m in self.masks.items()), list(self.rules))
+
+    def get_violations(self, column):
+        """Return the violations of one column as a compact Violations object"""
+        return violations_from_masks(dict((r, m[:, column]) for r, m in self.masks.items()), list(self.rules))
+
+    def get_stats(self, column=None):
+        """Return (center, LCL, UCL), as arrays over columns or for one column."""
+        if column is None:
+            return self.center, self.lcl, self.ucl
+        return self.center[column], self.lcl[column], self.ucl[column]
+
+
+
+class SpcIndex(object):
+    """
+    Prefix sums over a series (values, squares, moving ranges, subgroup
+    ranges and standard deviations). Control limits of any [start, end)
+    segment come back in constant time, so change points can be moved
+    around without reading the data again.
+    **Usage**
+    >>> idx = SpcIndex(values, CHART_X_MR_X)
+    >>> idx.get_stats(0, 500)
+    >>> idx.get_limits([300, 700, len(values)])
+    >>> spcs = idx.spc_with_changepoints([300, 700, len(values)], rules=RULES_ALL)
+    state continues the prefix sums of an index over earlier data, from its
+    prefix_state() at the first point of data, so the limits of a stream
+    that carries it are the same to the bit as the ones of the whole series.
+    """
+
+    def __init__(self, data, chart_type, sizes=None, chart_params=None, state=None):
+        assert chart_type in INDEX_CHARTS
+        data = np.asarray(data, dtype=float)
+        self.data = data
+        self.chart_type = chart_type
+        self.chart_params = {} if chart_params is None else dict(chart_params)
+        if sizes is None:
+            sizes = data.shape[1] if data.ndim > 1 else 1
+        assert np.ndim(sizes) == 0
+        self.size = sizes
+
+        if state is None:
+            state = {}
+        if data.ndim > 1:
+            values = np.mean(data, axis=1)
+            self._range = self._prefix(np.ptp(data, axis=1), state.get('range'))
+            self._std = self._prefix(np.std(data, axis=1, ddof=1), state.get('std'))
+        else:
+            values = data
+            self._mr = self._prefix(np.abs(np.diff(data)), state.get('mr'))
+        if 'offset' in state:
+            self._offset = state['offset']
+        else:
+            # sums are taken around the overall mean to keep segment sums precise
+            self._offset = np.mean(values) if len(values) > 0 else 0.0
+            if chart_type in (CHART_P, CHART_NP, CHART_C, CHART_U):
+                # counts minus a whole offset sum exactly, so equal windows give equal limits
+                self._offset = np.floor(self._offset)
+        self._sum = self._prefix(values - self._offset, state.get('sum'))
+        self._sq = self._prefix((values - self._offset)**2, state.get('sq'))
+
+    @staticmethod
+    def _prefix(values, start=None):
+        # cumsum adds in order, so continuing from start gives the sums of the whole series
+        if start is None:
+            return np.concatenate(([0.0], np.cumsum(values)))
+        return np.cumsum(np.concatenate(([start], values)))
+
+    def prefix_state(self, i):
+        """The offset and the prefix sums at point i, the state of an index over the data from i on."""
+        state = {'offset': self._offset, 'sum': self._sum[i], 'sq': self._sq[i]}
+        if self.data.ndim > 1:
+            state['range'] = self._range[i]
+            state['std'] = self._std[i]
+        else:
+            state['mr'] = self._mr[i]
+        return state
+
+    def __len__(self):
+        return len(self.data)
+
+    def mean(self, start, end):
+        """Mean of the values (subgroup means for subgroups) in [start, end)"""
+        return (self._sum[end] - self._sum[start]) / (end - start) + self._offset
+
+    def std(self, start, end):
+        """Standard deviation (ddof=1) of the values in [start, end)"""
+        n = end - start
+        s = self._sum[end] - self._sum[start]
+        sq = self._sq[end] - self._sq[start]
+        return np.sqrt(np.maximum(sq - s*s/n, 0) / (n - 1))
+
+    def mr_bar(self, start, end):
+        """Average moving range inside [start, end)"""
+        return (self._mr[end-1] - self._mr[start]) / (end - start - 1)
+
+    def r_bar(self, start, end):
+        """Average subgroup range in [start, end)"""
+        return (self._range[end] - self._range[start]) / (end - start)
+
+    def s_bar(self, start, end):
+        """Average subgroup standard deviation in [start, end)"""
+        return (self._std[end] - self._std[start]) / (end - start)
+
+    def get_stats(self, start=0, end=None):
+        """
+        Return (center, LCL, UCL) of the segment [start, end) in constant time,
+        the same as the get_stats_* function of the chart over that segment.
+        start and end may be arrays of segments, the limits are then arrays too.
+        """
+        if end is None:
+            end = len(self.data)
+        ct = self.chart_type
+        n = self.size
+        if ct == CHART_X_MR_X:
+            return _limits_x_mr_x(self.mean(start, end), self.mr_bar(start, end))
+        if ct == CHART_X_MR_MR:
+            return _limits_x_mr_mr(self.mr_bar(start, end))
+        if ct in (CHART_X_BAR_R_X, CHART_X_BAR_R_R, CHART_X_BAR_S_X, CHART_X_BAR_S_S):
+            assert 2 <= n <= 10
+            if ct == CHART_X_BAR_R_X:
+                return _limits_around(self.mean(start, end), self.r_bar(start, end), A2[n])
+            if ct == CHART_X_BAR_R_R:
+                return _limits_scaled(self.r_bar(start, end), D3[n], D4[n])
+            if ct == CHART_X_BAR_S_X:
+                return _limits_around(self.mean(start, end), self.s_bar(start, end), A3[n])
+            return _limits_scaled(self.s_bar(start, end), B3[n], B4[n])
+        if ct in (CHART_P, CHART_NP):
+            assert n > 1
+            pbar = self.mean(start, end) / n
+            return _limits_p(pbar, n) if ct == CHART_P else _limits_np(pbar, n)
+        if ct == CHART_C:
+            return _limits_c(self.mean(start, end))
+        if ct == CHART_U:
+            assert n > 1
+            return _limits_u(self.mean(start, end) / n, n)
+        if ct == CHART_CUSUM:
+            return 0, None, None
+        # CHART_CUSUM_TABULAR
+        sigma = self.chart_params.get('sigma')
+        if sigma is None:
+            sigma = self.mr_bar(start, end) / D2
+        big_h = self.chart_params.get('h', 5) * sigma
+        return 0, -big_h, big_h
+
+    def get_rolling_stats(self, window):
+        """
+        Return per-point (center, LCL, UCL) arrays over a trailing window: the
+        limits of point i come from the window points before it, [i-window, i),
+        and the first window points get the limits of [0, window). Every window
+        is a difference of prefix sums, so this is O(n) for any window length.
+        The arrays are aligned with the prepared data (p and u have the
+        leading point) and can be passed to Spc as stats_custom.
+        """
+        n = len(self.data)
+        assert self.chart_type in ROLLING_CHARTS
+        assert 2 <= window <= n
+        end = np.maximum(np.arange(n), window)
+        stats = []
+        for v in self.get_stats(end - window, end):
+            v = np.array(np.broadcast_to(v, (n,)), dtype=float)
+            if self.chart_type in (CHART_P, CHART_U):
+                v = np.concatenate((v[:1], v))
+            stats.append(v)
+        return tuple(stats)
+
+    def get_limits(self, change_points):
+        """Return (center, LCL, UCL) of every segment, change points as in spc_with_changepoints."""
+        stats = []
+        flag = 0
+        for cp in change_points:
+            stats.append(self.get_stats(flag, cp))
+            flag = cp
+        return stats
+
+    def spc_with_changepoints(self, change_points, rules=RULES_BASIC):
+        """
+        What-if segmentation: like spc_with_changepoints on the indexed data,
+        with the limits of every segment taken from the index.
+        """
+        spcs = []
+        flag = 0
+        for cp in change_points:
+            spcs.append(Spc(self.data[flag:cp], self.chart_type, rules=rules, sizes=self.size,
+                            stats_custom=self.get_stats(flag, cp), chart_params=self.chart_params))
+            flag = cp
+        return spcs
+
+
+def three_way_charts(data, rules=RULES_BASIC, within=CHART_X_BAR_R_R, **kwargs):
+    """
+    The three charts of a three-way (I-MR-R/S) analysis of subgroups, as a
+    list of Spc: the subgroup means with limits from their moving ranges
+    (CHART_THREE_WAY), the moving ranges of the means, and the ranges inside
+    the subgroups, or their standard deviations with within=CHART_X_BAR_S_S.
+    kwargs, e.g. profiler or cache, are passed to every Spc.
+    **Usage**
+    >>> means, mr, r = three_way_charts(subgroups, rules=RULES_WECO)
+    """
+    assert within in (CHART_X_BAR_R_R, CHART_X_BAR_S_S)
+    data = _as_float(data)
+    means = prepare_data_x_bar_rs_x(data, data.shape[1])
+    return [Spc(data, CHART_THREE_WAY, rules=rules, **kwargs),
+            Spc(means, CHART_X_MR_MR, rules=rules, **kwargs),
+            Spc(data, within, rules=rules, **kwargs)]
+
+
+def rolling_limits(data, chart_type, window, sizes=None):
+    """
+    Per-point (center, LCL, UCL) of a chart whose limits follow a slowly
+    drifting process: each point is checked against the limits of the window
+    points before it. See SpcIndex.get_rolling_stats().
+    **Usage**
+    >>> s = Spc(values, CHART_X_MR_X, stats_custom=rolling_limits(values, CHART_X_MR_X, 200))
+    """
+    return SpcIndex(data, chart_type, sizes=sizes).get_rolling_stats(window)
+
 
 
 # In[6]:
 
 
-def get_chart_with_changepoints(values, spcs, legend=True, title=None, index=None):
-    """Generate chart using matplotlib."""
+def get_chart_with_changepoints(values, spcs, legend=True, title=None, index=None, figure=None):
+    """
+    Generate chart using matplotlib.
+    figure: draw into this figure instead of a new pyplot one, e.g. one
+    from chart_figure() reused for many charts in headless mode.
+    """
+    with _stage(spcs[0].profiler, 'chart', sum(len(s._data) for s in spcs)):
+        return _get_chart_with_changepoints(values, spcs, legend, title, index, figure)
+
+
+def _get_chart_with_changepoints(values, spcs, legend, title, index, figure):
     try:
         import matplotlib
     except ImportError:
         raise Exception("matplotlib not installed")
     else:
         import matplotlib.pyplot as plt
-        import matplotlib.lines as mlines
-
-    if index is not None and not isinstance(index, list):
-        index = list(index)
 
     size = len(spcs)
-    center = []
-    ucl = []
-    lcl= []
-    data = []
-    for i in range(size):
-        data += spcs[i]._data
+    lengths = [len(spcs[i]._data) for i in range(size)]
+    starts = np.concatenate(([0], np.cumsum(lengths)))
+    data = np.concatenate([np.asarray(spcs[i]._data, dtype=float) for i in range(size)])
+    x = np.arange(len(data)) if index is None else np.asarray(index)
 
-
-    plt.figure(figsize=(20, 10))
-    ax = plt.subplot(111)
-
-    if index is None:
-        plt.plot(data, "bo-", ms=5, label='Data')
+    if figure is None:
+        plt.figure(figsize=(20, 10))
+        ax = plt.subplot(111)
     else:
-        plt.plot(index, data, "bo-", ms=5, label='Data')
+        figure.clear()
+        ax = figure.add_subplot(111)
 
-    title = spcs[0].chart_type if title is None else title
-    plt.title(title, fontsize=22)  # setting the title for the figure
+    ax.plot(x, data, "bo-", ms=5, label='Data')
 
+    title = spcs[0].chart_type if title is None else title
+    ax.set_title(title, fontsize=22)  # setting the title for the figure
 
+    # limits are steps that change at the segment boundaries
+    per_point = any(np.ndim(v) > 0 for s in spcs for v in s.get_stats())
     if spcs[0].center is not None:
-        for i in range(size):
-            center += [spcs[i].center]*len(spcs[i]._data)
-        plt.plot(center, color='k', linestyle='-', label='Center ')
+        center = _segment_steps(x, starts, [s.center for s in spcs], per_point)
+        ax.step(center[0], center[1], where='post', color='k', linestyle='-', label='Center ')
 
     if spcs[0].ucl is not None:
-        for i in range(size):
-            ucl += [spcs[i].ucl]*len(spcs[i]._data)
-        plt.plot(ucl, color='r', linestyle='-.', label='UCL ')
-        plt.plot(np.array(center)+(np.array(ucl)-np.array(center))/3, color='r', linestyle=':', linewidth=2, label='1 Sigma')
-        plt.plot(np.array(center)+(np.array(ucl)-np.array(center))*2/3, color='r', linestyle=':', linewidth=2, label='2 Sigma')
+        ucl = _segment_steps(x, starts, [s.ucl for s in spcs], per_point)
+        ax.step(ucl[0], ucl[1], where='post', color='r', linestyle='-.', label='UCL ')
+        ax.step(ucl[0], center[1]+(ucl[1]-center[1])/3, where='post', color='r', linestyle=':', linewidth=2, label='1 Sigma')
+        ax.step(ucl[0], center[1]+(ucl[1]-center[1])*2/3, where='post', color='r', linestyle=':', linewidth=2, label='2 Sigma')
 
     if spcs[0].lcl is not None:
-        for i in range(size):
-            lcl += [spcs[i].lcl]*len(spcs[i]._data)
-        plt.plot(lcl, color='r', linestyle='-.', label='LCL ')
-        plt.plot(np.array(center)-(np.array(center)-np.array(lcl))/3, color='r', linestyle=':', linewidth=2, label='1 Sigma')
-        plt.plot(np.array(center)-(np.array(center)-np.array(lcl))*2/3, color='r', linestyle=':', linewidth=2, label='2 Sigma')
-
-    start_indx = 0
-    legnd = []
-
-    for j in range(size):
-        if RULES_7_ON_ONE_SIDE in spcs[j].violating_points:   ######     1
-            legnd += [1]
-            for i in spcs[j].violating_points[RULES_7_ON_ONE_SIDE]:
-                if index is not None:
-                    ax.plot([index[i]], [spcs[j]._data[i]], "kD", ms=10)
-                else:
-                    ax.plot([i+start_indx], [spcs[j]._data[i]], "kD", ms=10)
-#            ax.plot([], [], color='black', linestyle='', marker='D', ms=10, label='Run of 7')
-
-        if RULES_8_ON_ONE_SIDE in spcs[j].violating_points:   ######     2
-            legnd += [2]
-            for i in spcs[j].violating_points[RULES_8_ON_ONE_SIDE]:
-                if index is not None:
-                    ax.plot([index[i]], [spcs[j]._data[i]], "yo", ms=10)
-                else:
-                    ax.plot([i+start_indx], [spcs[j]._data[i]], "yo", ms=10)
-#            ax.plot([], [], color='yellow', linestyle='', marker='o', ms=10, label='Run of 8')
-
-        if RULES_9_ON_ONE_SIDE in spcs[j].violating_points:   ######     3
-            legnd += [3]
-            for i in spcs[j].violating_points[RULES_9_ON_ONE_SIDE]:
-                if index is not None:
-                    ax.plot([index[i]], [spcs[j]._data[i]], "ko", ms=10)
-                else:
-                    ax.plot([i+start_indx], [spcs[j]._data[i]], "ko", ms=10)
-#            ax.plot([], [], color='black', linestyle='', marker='o', ms=10, label='Run of 9')
-
-        if RULES_2_OF_3_BEYOND_2SIGMA in spcs[j].violating_points:   ######     4
-            legnd += [4]
-            for i in spcs[j].violating_points[RULES_2_OF_3_BEYOND_2SIGMA]:
-                if index is not None:
-                    ax.plot([index[i]], [spcs[j]._data[i]], "go", ms=10)
-                else:
-                    ax.plot([i+start_indx], [spcs[j]._data[i]], "go", ms=10)
-#            ax.plot([], [], color='green', linestyle='', marker='o', ms=10, label='2 of 3 Beyond 2 Sigma ')
-
-        if RULES_4_OF_5_BEYOND_1SIGMA in spcs[j].violating_points:  ######     5
-            legnd += [5]
-            for i in spcs[j].violating_points[RULES_4_OF_5_BEYOND_1SIGMA]:
-                if index is not None:
-                    ax.plot([index[i]], [spcs[j]._data[i]], "co", ms=10)
-                else:
-                    ax.plot([i+start_indx], [spcs[j]._data[i]], "co", ms=10)
-#            ax.plot([], [], color='cyan', linestyle='', marker='o', ms=10, label='4 of 5 Beyond 1 Sigma ')
-
-        if RULES_15_BELOW_1SIGMA in spcs[j].violating_points:  ######     6
-            legnd += [6]
-            for i in spcs[j].violating_points[RULES_15_BELOW_1SIGMA]:
-                if index is not None:
-                    ax.plot([index[i]], [spcs[j]._data[i]], "mv", ms=10)
-                else:
-                    ax.plot([i+start_indx], [spcs[j]._data[i]], "mv", ms=10)
-#            ax.plot([], [], color='magenta', linestyle='', marker='v', ms=10, label='15 Below 1 Sigma ')
-
-        if RULES_14_UP_DOWN in spcs[j].violating_points:   ######     7
-            legnd += [7]
-            for i in spcs[j].violating_points[RULES_14_UP_DOWN]:
-                if index is not None:
-                    ax.plot([index[i]], [spcs[j]._data[i]], "mo", ms=8)
-                else:
-                    ax.plot([i+start_indx], [spcs[j]._data[i]], "mo", ms=8)
-#            ax.plot([], [], color='magenta', linestyle='', marker='o', ms=8, label='14 Up and Down ')
-
-        if RULES_6_TRENDING in spcs[j].violating_points:  ######     8
-            legnd += [8]
-            for i in spcs[j].violating_points[RULES_6_TRENDING]:
-                if index is not None:
-                    ax.plot([index[i]], [spcs[j]._data[i]], "cv", ms=10)
-                else:
-                    ax.plot([i+start_indx], [spcs[j]._data[i]], "cv", ms=10)
-#            ax.plot([], [], color='magenta', linestyle='', marker='v', ms=10, label='6 Trending')
-
-
-        if RULES_8_BEYOND_1SIGMA_BOTH_SIDES in spcs[j].violating_points:  ######     10
-            legnd += [10]
-            for i in spcs[j].violating_points[RULES_8_BEYOND_1SIGMA_BOTH_SIDES]:
-                if index is not None:
-                    ax.plot([index[i]], [spcs[j]._data[i]], "kv", ms=10)
-                else:
-                    ax.plot([i+start_indx], [spcs[j]._data[i]], "kv", ms=10)
-#            ax.plot([], [], color='black', linestyle='', marker='v', ms=10, label='8 Beyond 1 Sigma on Both Sides')
-
-        if RULES_1_BEYOND_3SIGMA in spcs[j].violating_points:   ######     9
-            legnd += [9]
-            for i in spcs[j].violating_points[RULES_1_BEYOND_3SIGMA]:
-                if index is not None:
-                    ax.plot([index[i]], [spcs[j]._data[i]], "ro", ms=10)
-                else:
-                    ax.plot([i+start_indx], [spcs[j]._data[i]], "ro", ms=10)
-#            ax.plot([], [], color='red', linestyle='', marker='o', ms=10, label='Out of Limits')
-
-        start_indx += len(spcs[j]._data)
-
-    if 1 in legnd:
-        ax.plot([], [], color='black', linestyle='', marker='D', ms=10, label='Run of 7')
-    if 2 in legnd:
-        ax.plot([], [], color='yellow', linestyle='', marker='o', ms=10, label='Run of 8')
-    if 3 in legnd:
-        ax.plot([], [], color='black', linestyle='', marker='o', ms=10, label='Run of 9')
-    if 4 in legnd:
-        ax.plot([], [], color='green', linestyle='', marker='o', ms=10, label='2 of 3 Beyond 2 Sigma ')
-    if 5 in legnd:
-        ax.plot([], [], color='cyan', linestyle='', marker='o', ms=10, label='4 of 5 Beyond 1 Sigma ')
-    if 6 in legnd:
-        ax.plot([], [], color='magenta', linestyle='', marker='v', ms=10, label='15 Below 1 Sigma ')
-    if 7 in legnd:
-        ax.plot([], [], color='magenta', linestyle='', marker='o', ms=8, label='14 Up and Down ')
-    if 8 in legnd:
-        ax.plot([], [], color='cyan', linestyle='', marker='v', ms=10, label='6 Trending')
-    if 9 in legnd:
-        ax.plot([], [], color='red', linestyle='', marker='o', ms=10, label='Out of Limits')
-    if 10 in legnd:
-        ax.plot([], [], color='black', linestyle='', marker='v', ms=10, label='8 Beyond 1 Sigma on Both Sides')
-
-
-    # readability improvements
-    ax.spines["top"].set_visible(False)
-    ax.spines["right"].set_visible(False)
-    ax.get_xaxis().tick_bottom()
-    ax.get_yaxis().tick_left()
-    plt.xticks(fontsize=14)
-    plt.yticks(fontsize=14)
-    plt.grid(axis='y')
-    ylim = plt.ylim()
-    plt.ylim((ylim[0]-1, ylim[1]+1))
+        lcl = _segment_steps(x, starts, [s.lcl for s in spcs], per_point)
+        ax.step(lcl[0], lcl[1], where='post', color='r', linestyle='-.', label='LCL ')
+        ax.step(lcl[0], center[1]-(center[1]-lcl[1])/3, where='post', color='r', linestyle=':', linewidth=2, label='1 Sigma')
+        ax.step(lcl[0], center[1]-(center[1]-lcl[1])*2/3, where='post', color='r', linestyle=':', linewidth=2, label='2 Sigma')
+
+    # one line of markers per rule over all the segments, the legend in its own order
+    for r in CHANGEPOINT_CHART_RULES:
+        idx = [spcs[j].violations.points(r) + starts[j]
+               for j in range(size) if r in spcs[j].violations]
+        if len(idx) > 0:
+            idx = np.concatenate(idx)
+            fmt, ms, label = CHANGEPOINT_CHART_MARKERS[r]
+            ax.plot(x[idx], data[idx], fmt, ms=ms, linestyle='')
+    for r in CHANGEPOINT_CHART_LEGEND:
+        if any(r in spcs[j].violations for j in range(size)):
+            fmt, ms, label = CHANGEPOINT_CHART_MARKERS[r]
+            ax.plot([], [], fmt, linestyle='', ms=ms, label=label)
+
+    _chart_readability(ax)
 
     legend_output = None
     if legend is True:
-        legend_output = plt.legend(bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0.)
+        legend_output = ax.legend(bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0.)
     return ax, legend_output
 
 
+def _segment_steps(x, starts, limits, per_point):
+    """
+    Step vertices of a limit over segments: one vertex per segment start and
+    one at the end, or every point when some segment has per-point limits.
+    """
+    if not per_point:
+        xs = np.append(x[starts[:-1]], x[-1])
+        ys = np.append(np.asarray(limits, dtype=float), limits[-1])
+        return xs, ys
+    ys = np.concatenate([np.broadcast_to(v, (starts[i+1]-starts[i],)) for i, v in enumerate(limits)])
+    return x, ys.astype(float)
+
+
+def chart_figure(figsize=(20, 10)):
+    """
+    Figure for headless rendering with the Agg backend, not tracked by pyplot.
+    Pass it as figure= to the chart functions to reuse it for many charts,
+    then save it with figure.savefig().
+    """
+    try:
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+    except ImportError:
+        raise Exception("matplotlib not installed")
+    figure = Figure(figsize=figsize)
+    FigureCanvasAgg(figure)
+    return figure
+
+
+
+# Worker side of export_charts: every worker process renders with the Agg
+# backend into one figure that is cleared and reused for all its charts.
+_export_figure = None
+
+
+def _init_export_worker(figsize):
+    global _export_figure
+    import matplotlib
+    matplotlib.use('Agg')
+    _export_figure = chart_figure(figsize)
 
 
-def spc_with_changepoints(data, chart_type, change_points, rules=RULES_BASIC, stats_custom=None, newdata=None, sizes=None):
+def _export_chart_task(task):
+    name, spcs, path, dpi = task
+    if isinstance(spcs, Spc):
+        spcs = [spcs]
+    get_chart_with_changepoints(None, spcs, title=name, figure=_export_figure)
+    _export_figure.savefig(path, dpi=dpi, bbox_inches='tight')
+    _export_figure.clear()
+    violations = {}
+    for s in spcs:
+        for r, count in s.violations.counts().items():
+            violations[r] = violations.get(r, 0) + count
+    return {'name': name, 'file': os.path.basename(path), 'chart_type': spcs[0].chart_type,
+            'segments': len(spcs), 'points': sum(len(s._data) for s in spcs), 'violations': violations}
+
+
+def export_charts(charts, directory, fmt='png', max_workers=None, dpi=100, figsize=(20, 10)):
+    """
+    Render many charts to files in a pool of worker processes.
+    charts is a dict or an iterable of (name, spcs) pairs, where spcs is one
+    Spc or the list returned by spc_with_changepoints. Every chart is written
+    as <name>.<fmt> (png or svg) into directory, together with manifest.json
+    that lists the files, chart types, sizes and violation counts. Characters
+    other than letters, digits and '-_.' become '_'; names that end up equal
+    (ignoring case) get a suffix _2, _3, ... and the manifest records the
+    file actually written.
+    Workers use the Agg backend and reuse one figure, and only a few charts
+    per worker are in flight, so memory stays bounded for any number of
+    charts when they come from a generator.
+    Returns the manifest entries in input order.
+    """
+    assert fmt in ('png', 'svg')
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    if isinstance(charts, dict):
+        charts = charts.items()
+    workers = max_workers or os.cpu_count() or 1
+
+    manifest = []
+    pending = deque()
+    used = set()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_export_worker,
+                             initargs=(figsize,)) as executor:
+        for name, spcs in charts:
+            base = "".join(c if c.isalnum() or c in '-_.' else '_' for c in str(name))
+            filename, suffix = base, 1
+            while filename.lower() in used:
+                suffix += 1
+                filename = '%s_%d' % (base, suffix)
+            used.add(filename.lower())
+            path = os.path.join(directory, '%s.%s' % (filename, fmt))
+            pending.append(executor.submit(_export_chart_task, (name, spcs, path, dpi)))
+            if len(pending) >= 2*workers:
+                manifest.append(pending.popleft().result())
+        while pending:
+            manifest.append(pending.popleft().result())
+
+    with open(os.path.join(directory, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    return manifest
+
+
+def _segment_sizes(sizes, start, end):
+    """Sample sizes of the points [start, end): per-point sizes are sliced, one size is kept."""
+    if sizes is not None and np.ndim(sizes) > 0:
+        return np.asarray(sizes)[start:end]
+    return sizes
+
+
+def spc_with_changepoints(data, chart_type, change_points, rules=RULES_BASIC, stats_custom=None, newdata=None, sizes=None,
+                          profiler=None, cache=None):
 
     parts = len(change_points)#+1
 #    change_points.append(len(data))
     SPCs = []
     flag = 0
-    data = np.array(data)
+    data = np.asarray(data)
 
     for i in range(parts):
-        if len(data.shape)>1:
-            spc = Spc(data[flag:change_points[i],:], chart_type, rules = rules )
-        else:
-            spc = Spc(data[flag:change_points[i]], chart_type, rules = rules )
+        with _stage(profiler, 'segment', change_points[i] - flag):
+            segment_sizes = _segment_sizes(sizes, flag, change_points[i])
+            if len(data.shape)>1:
+                spc = Spc(data[flag:change_points[i],:], chart_type, rules = rules, sizes=segment_sizes,
+                          profiler=profiler, cache=cache)
+            else:
+                spc = Spc(data[flag:change_points[i]], chart_type, rules = rules, sizes=segment_sizes,
+                          profiler=profiler, cache=cache)
         SPCs.append(spc)
         flag = change_points[i]
 
     return SPCs
 
 
+# Automatic changepoint detection. Segment costs come from prefix sums of the
+# data and of its squares, so any segment is evaluated in constant time.
+
+CHANGEPOINT_BINSEG = "binary segmentation"
+CHANGEPOINT_PELT = "pelt"
+
+COST_MEAN = "mean"
+COST_MEAN_VAR = "mean and variance"
+
+# PELT is skipped for binary segmentation above about this many cost evaluations
+PELT_MAX_WORK = 10**8
+
+
+def _changepoint_prefix_sums(data, cost):
+    data = np.asarray(data, dtype=float)
+    if data.ndim > 1:
+        # subgroups are segmented on their means
+        data = np.mean(data, axis=1)
+    data = data - np.mean(data)
+    if cost == COST_MEAN:
+        # scale by a shift-robust sigma estimate so the penalty is in sigma units
+        sigma = np.median(np.abs(np.diff(data))) / (0.6745 * np.sqrt(2))
+        if sigma > 0:
+            data = data / sigma
+    s1 = np.concatenate(([0.0], np.cumsum(data)))
+    s2 = np.concatenate(([0.0], np.cumsum(data * data)))
+    return s1, s2, _variance_floor(data)
+
+
+def _variance_floor(data):
+    """
+    Smallest segment variance the mean and variance cost tells apart: the
+    rounding noise of the measurement resolution, the smallest step between
+    values, and a small fraction of the overall variance. Segments of equal
+    counts would otherwise cost log(0) and split everywhere.
+    """
+    steps = np.diff(np.unique(data))
+    resolution = np.min(steps) if len(steps) > 0 else 0.0
+    return max(resolution**2 / 12, 1e-6 * np.var(data), np.finfo(float).tiny)
+
+
+def _segment_cost(s1, s2, start, end, cost, floor):
+    """Cost of segments [start, end), vectorized over arrays of starts and ends."""
+    m = end - start
+    sums = s1[end] - s1[start]
+    sq = s2[end] - s2[start]
+    if cost == COST_MEAN:
+        return sq - sums*sums/m
+    var = sq/m - (sums/m)**2
+    return m * np.log(np.maximum(var, floor))
+
+
+def _binary_segmentation(s1, s2, floor, n, cost, penalty, min_size):
+    change_points = []
+    segments = [(0, n)]
+    while segments:
+        a, b = segments.pop()
+        if b - a < 2*min_size:
+            continue
+        splits = np.arange(a+min_size, b-min_size+1)
+        costs = (_segment_cost(s1, s2, np.full(len(splits), a), splits, cost, floor) +
+                 _segment_cost(s1, s2, splits, np.full(len(splits), b), cost, floor))
+        best = np.argmin(costs)
+        if _segment_cost(s1, s2, a, b, cost, floor) - costs[best] > penalty:
+            t = int(splits[best])
+            change_points.append(t)
+            segments += [(a, t), (t, b)]
+    return sorted(change_points)
+
+
+def _pelt(s1, s2, floor, n, cost, penalty, min_size):
+    f = np.empty(n+1)
+    f[0] = -penalty
+    last = np.zeros(n+1, dtype=int)
+    # the candidates are the first count items of one preallocated buffer
+    buf = np.zeros(n+1, dtype=int)
+    count = 1
+    for t in range(min_size, n+1):
+        if t >= 2*min_size:
+            buf[count] = t-min_size
+            count += 1
+        candidates = buf[:count]
+        c = f[candidates] + _segment_cost(s1, s2, candidates, t, cost, floor)
+        best = np.argmin(c)
+        f[t] = c[best] + penalty
+        last[t] = candidates[best]
+        # candidates that can never be optimal again are pruned
+        kept = candidates[c <= f[t]]
+        count = len(kept)
+        buf[:count] = kept
+    change_points = []
+    t = last[n]
+    while t > 0:
+        change_points.append(int(t))
+        t = last[t]
+    return sorted(change_points)
+
+
+def detect_change_points(data, method=CHANGEPOINT_BINSEG, cost=COST_MEAN, penalty=None, min_size=10):
+    """
+    Detect changes of the process mean (COST_MEAN) or of mean and variance
+    (COST_MEAN_VAR) by penalized segmentation.
+    CHANGEPOINT_BINSEG splits recursively, every level is vectorized and it
+    runs in about O(n log n). CHANGEPOINT_PELT finds the optimal segmentation
+    with pruning, in a loop over points; its run time grows with n times the
+    segment length, so it suits series with frequent changes. Binary
+    segmentation estimates that work first: above PELT_MAX_WORK its result
+    is returned instead, with a warning.
+    penalty is the cost of a new segment, 2*log(n) by default.
+    Returns change points in the form spc_with_changepoints takes them,
+    ending with len(data).
+    """
+    n = len(data)
+    if penalty is None:
+        penalty = 2 * np.log(max(n, 2))
+    s1, s2, floor = _changepoint_prefix_sums(data, cost)
+    change_points = _binary_segmentation(s1, s2, floor, n, cost, penalty, min_size)
+    if method == CHANGEPOINT_PELT and n >= min_size:
+        # PELT keeps about a segment length of candidates at every point
+        work = n * n / float(len(change_points) + 1)
+        if work > PELT_MAX_WORK:
+            warnings.warn('PELT on %d points with segments of about %d points would take about %.0e '
+                          'cost evaluations, using binary segmentation' % (n, n // (len(change_points) + 1), work))
+        else:
+            change_points = _pelt(s1, s2, floor, n, cost, penalty, min_size)
+    return change_points + [n]
+
+
+def spc_with_detected_changepoints(data, chart_type, rules=RULES_BASIC, method=CHANGEPOINT_BINSEG,
+                                   cost=COST_MEAN, penalty=None, min_size=10, profiler=None):
+    """
+    Detect change points and evaluate every segment with its own limits.
+    Returns the change points and the list of Spc, one per segment.
+    """
+    with _stage(profiler, 'detect', len(data)):
+        change_points = detect_change_points(data, method, cost, penalty, min_size)
+    return change_points, spc_with_changepoints(data, chart_type, change_points, rules=rules, profiler=profiler)
+
+
+# Loaders for large input files. They return read-only ndarrays backed by the
+# file, or chunks of it, which Spc, SpcIndex and SpcColumns take as they are.
+
+def load_npy(path):
+    """
+    Open a .npy file memory-mapped read-only. Pages are read only when the
+    computations touch them, and slices are views into the file.
+    """
+    return np.load(path, mmap_mode='r')
+
+
+def load_binary(path, dtype=np.float64, columns=None, offset=0):
+    """
+    Open a raw binary file of dtype values memory-mapped read-only.
+    columns reshapes it to (n, columns) subgroups, offset skips a header
+    of that many bytes.
+    """
+    data = np.memmap(path, dtype=dtype, mode='r', offset=offset)
+    if columns is not None:
+        data = data.reshape((-1, columns))
+    return data
+
+
+def iter_binary_chunks(path, chunk_size=1000000, dtype=np.float64, columns=None, offset=0):
+    """Yield consecutive chunks of chunk_size rows of a binary file, as views of its memory map."""
+    data = load_binary(path, dtype, columns, offset)
+    for start in range(0, len(data), chunk_size):
+        yield data[start:start+chunk_size]
+
+
+def iter_csv_chunks(path, chunk_size=100000, delimiter=',', usecols=0, skiprows=0, dtype=np.float64):
+    """
+    Yield a CSV file in chunks of chunk_size rows, so only one chunk is in
+    memory at a time. usecols=0 gives flat chunks of the first column,
+    a list of columns gives (rows, columns) chunks, e.g. subgroups.
+    """
+    ndmin = 1 if isinstance(usecols, int) else 2
+    with open(path) as f:
+        for _ in islice(f, skiprows):
+            pass
+        while True:
+            lines = list(islice(f, chunk_size))
+            if len(lines) == 0:
+                break
+            chunk = np.loadtxt(lines, delimiter=delimiter, usecols=usecols, dtype=dtype, ndmin=ndmin)
+            if len(chunk) > 0:
+                yield chunk
+
+
+def load_csv(path, chunk_size=100000, delimiter=',', usecols=0, skiprows=0, dtype=np.float64):
+    """Read a CSV file chunk by chunk into one array."""
+    chunks = list(iter_csv_chunks(path, chunk_size, delimiter, usecols, skiprows, dtype))
+    if len(chunks) == 0:
+        return np.zeros((0,) if isinstance(usecols, int) else (0, len(usecols)), dtype=dtype)
+    return np.concatenate(chunks)
+
+
+def csv_to_binary(path, out, chunk_size=100000, delimiter=',', usecols=0, skiprows=0, dtype=np.float64):
+    """
+    Convert a CSV file to a raw binary one chunk by chunk, and return it
+    memory-mapped with load_binary(). CSV exports larger than the memory
+    are parsed once and analyzed from the map afterwards.
+    """
+    columns = None
+    with open(out, 'wb') as f:
+        for chunk in iter_csv_chunks(path, chunk_size, delimiter, usecols, skiprows, dtype):
+            if chunk.ndim == 2:
+                columns = chunk.shape[1]
+            chunk.tofile(f)
+    return load_binary(out, dtype, columns)
+
+
+class SpcChecker(object):
+    """
+    Phase II state of one series: checks chunks of new observations against
+    the fixed limits of an Spc, each chunk in one vectorized pass, carrying
+    the last points and the running state of the chart over to the next
+    chunk. Used by Spc.monitor() and SpcMonitor; the Spc is not changed.
+    """
+
+    def __init__(self, spc):
+        assert np.ndim(spc.size) == 0
+        self.spc = spc
+        self.rules = list(spc.rules)
+        self.carry = dict(spc._carry)
+        # enough history for the longest window, as in Spc._start_stream()
+        self.tail_len = max([_rule_points(r) for r in self.rules] + [1]) + 2
+        self.tail = np.asarray(spc._data[-self.tail_len:], dtype=float)
+        self.start = len(spc._data)
+        self.per_point = np.ndim(spc.lcl) > 0
+        if self.per_point:
+            assert spc.chart_type == CHART_EWMA or spc.window is not None
+        if spc.window is not None:
+            # limits of the tail points, the next ones come from the carried window
+            self.limits = tuple(np.asarray(v[-self.tail_len:], dtype=float) for v in spc.get_stats())
+
+    def check(self, values):
+        """Check one chunk, returns (start, end, points) like Spc.monitor()."""
+        spc = self.spc
+        tail = self.tail
+        start = self.start
+        with _stage(spc.profiler, 'monitor', len(values)):
+            values = _as_float(values, spc.dtype)
+            data2 = np.asarray(spc._prepare_new(values, tail[-1], self.carry), dtype=float)
+            window = np.concatenate((tail, data2))
+            center = spc.center
+            if spc.window is not None:
+                new = spc._rolling_new(values, self.carry)
+                center, lcl, ucl = [np.concatenate((a, b))[-len(window):] for a, b in zip(self.limits, new)]
+                self.limits = tuple(v[-self.tail_len:] for v in (center, lcl, ucl))
+            elif self.per_point:
+                lcl, ucl = ewma_limits(spc.chart_params, start - len(tail), len(window))
+            else:
+                lcl, ucl = spc.lcl, spc.ucl
+            # a full tail is longer than any rule window, so the first points left
+            # unchecked by find_violation_masks are either in the tail or the series start
+            masks = find_violation_masks(window, center, lcl, ucl, self.rules, spc.profiler)
+            masks = dict((r, m[len(tail):]) for r, m in masks.items())
+            found = violations_from_masks(masks, self.rules, 'index')
+            points = dict((r, (np.repeat(found.points(r), found.repeats[r]) + start).tolist())
+                          for r in found.rules)
+        self.tail = window[-self.tail_len:]
+        self.start = start + len(data2)
+        return start, self.start, points
+
+
+def monitor_chunks(baseline, chunks, chart_type, rules=RULES_BASIC, stats_custom=None, sizes=None,
+                   chart_params=None, profiler=None):
+    """
+    Out-of-core Phase I / Phase II pipeline. The limits come from baseline
+    (Phase I), or from stats_custom with baseline only giving the history,
+    then the chunks, e.g. from iter_csv_chunks() or iter_binary_chunks(),
+    are checked against them by Spc.monitor().
+    Yields (start, end, points) for every chunk, indexes counted from the
+    start of baseline.
+    """
+    spc = Spc(baseline, chart_type, rules=rules, stats_custom=stats_custom, sizes=sizes,
+              chart_params=chart_params, profiler=profiler)
+    return spc.monitor(chunks)
+
+
+class _MonitoredStream(object):
+
+    def __init__(self, name, spc):
+        self.name = name
+        self.checker = SpcChecker(spc)
+        # shape of one observation: () for flat charts, (size,) for subgroups
+        self.shape = (spc.size,) if spc.chart_type in SUBGROUP_CHARTS + MULTIVARIATE_CHARTS else ()
+        # single observations, and batches already turned into arrays
+        self.values = []
+        self.pieces = []
+        self.count = 0
+        self.since = None
+        self.lock = asyncio.Lock()
+        self.points = 0
+        self.batches = 0
+        self.events = 0
+
+    def add(self, item, now):
+        if isinstance(item, np.ndarray) and item.ndim == len(self.shape) + 1:
+            self._close_values()
+            self.pieces.append(item)
+            self.count += len(item)
+        else:
+            self.values.append(item)
+            self.count += 1
+        if self.since is None:
+            self.since = now
+
+    def _close_values(self):
+        if self.values:
+            self.pieces.append(np.asarray(self.values, dtype=float).reshape((-1,) + self.shape))
+            self.values = []
+
+    def take(self):
+        self._close_values()
+        pieces, self.pieces = self.pieces, []
+        self.count = 0
+        self.since = None
+        if len(pieces) == 0:
+            return None
+        return pieces[0] if len(pieces) == 1 else np.concatenate(pieces)
+
+
+class SpcMonitor(object):
+    """
+    asyncio monitoring of many named streams. Every stream has its own Spc
+    with the limits (Phase I) and its own rule state. Incoming observations
+    are collected in micro-batches of batch_size points, or for at most
+    batch_interval seconds, and every batch is checked in one vectorized
+    pass by SpcChecker.
+    Violations are sent to callback(event), an async function, as dicts
+    {'stream', 'start', 'end', 'points'} with points in the form of
+    get_violating_points(). At most max_events events wait for the
+    callback; when they do, put() and the stream readers wait too, so a
+    slow consumer slows the intake instead of filling the memory.
+    Observations come from async iterators given to add_stream() (one
+    observation per item, or a batch as an ndarray) or are pushed by put().
+    **Usage**
+    >>> async def alarm(event):
+    ...     print(event['stream'], event['points'])
+    >>> monitor = SpcMonitor(alarm)
+    >>> monitor.add_stream('line 1', Spc(baseline1, CHART_X_MR_X, rules=RULES_WECO), source=readings1())
+    >>> monitor.add_stream('line 2', Spc(baseline2, CHART_X_MR_X))
+    >>> await monitor.start()
+    >>> await monitor.put('line 2', [0.2, 0.4, 3.9])
+    >>> await monitor.run()
+    """
+
+    def __init__(self, callback, batch_size=1024, batch_interval=0.1, max_events=1000):
+        self.callback = callback
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.streams = {}
+        self._sources = {}
+        self._events = asyncio.Queue(maxsize=max_events)
+        self._readers = []
+        self._tasks = []
+
+    def add_stream(self, name, spc, source=None):
+        """Watch a stream with the limits and rules of spc; source is an optional async iterator."""
+        assert name not in self.streams
+        self.streams[name] = _MonitoredStream(name, spc)
+        if source is not None:
+            self._sources[name] = source
+            if self._tasks:
+                self._readers.append(asyncio.ensure_future(self._read(self.streams[name], source)))
+
+    async def start(self):
+        """Start the callback, the time-based flushing and the readers of the sources."""
+        if self._tasks:
+            return
+        self._tasks = [asyncio.ensure_future(self._emit()), asyncio.ensure_future(self._tick())]
+        self._readers = [asyncio.ensure_future(self._read(self.streams[name], source))
+                         for name, source in self._sources.items()]
+
+    async def put(self, name, values):
+        """Push a batch of observations to a stream, waits while the callback is behind."""
+        stream = self.streams[name]
+        now = asyncio.get_running_loop().time()
+        if isinstance(values, np.ndarray):
+            stream.add(values, now)
+        else:
+            for v in values:
+                stream.add(v, now)
+        if stream.count >= self.batch_size:
+            await self._flush(stream)
+
+    async def run(self):
+        """Run until all the sources are exhausted, then stop()."""
+        await self.start()
+        while self._readers:
+            readers, self._readers = self._readers, []
+            await asyncio.gather(*readers)
+        await self.stop()
+
+    async def stop(self):
+        """Check what is left in the batches, deliver the last events and stop the tasks."""
+        if not self._tasks:
+            return
+        emit, tick = self._tasks
+        tasks = [tick] + self._readers
+        for t in tasks:
+            t.cancel()
+        # a cancelled flush still delivers the batch it took, see _flush()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._readers = []
+        for stream in list(self.streams.values()):
+            await self._flush(stream)
+        await self._events.put(None)
+        self._tasks = []
+        await emit
+
+    def stats(self):
+        """Return stream name -> points checked, batches and violation events."""
+        return dict((name, {'points': s.points, 'batches': s.batches, 'events': s.events})
+                    for name, s in self.streams.items())
+
+    async def _read(self, stream, source):
+        loop = asyncio.get_running_loop()
+        async for item in source:
+            stream.add(item, loop.time())
+            if stream.count >= self.batch_size:
+                await self._flush(stream)
+        await self._flush(stream)
+
+    async def _tick(self):
+        # flush the batches of streams that went quiet
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.batch_interval / 2)
+            now = loop.time()
+            for stream in list(self.streams.values()):
+                if stream.since is not None and now - stream.since >= self.batch_interval:
+                    await self._flush(stream)
+
+    async def _flush(self, stream):
+        # shielded, so a reader or the tick cancelled by stop() does not lose
+        # a batch taken from the stream while its event waits for the callback
+        await asyncio.shield(self._check(stream))
+
+    async def _check(self, stream):
+        # the lock keeps the batches of a stream and their events in order
+        async with stream.lock:
+            values = stream.take()
+            if values is None:
+                return
+            start, end, points = stream.checker.check(values)
+            stream.points += end - start
+            stream.batches += 1
+            if points:
+                stream.events += 1
+                await self._events.put({'stream': stream.name, 'start': start, 'end': end, 'points': points})
+
+    async def _emit(self):
+        while True:
+            event = await self._events.get()
+            if event is None:
+                return
+            result = self.callback(event)
+            if asyncio.iscoroutine(result):
+                await result
+
+
+# Worker side of spc_with_changepoints_many: every worker process attaches the
+# shared memory block once and reads its segments from there.
+_shared_data = None
+
+
+def _attach_shared_data(name):
+    global _shared_data
+    shm = shared_memory.SharedMemory(name=name)
+    _shared_data = (shm, np.ndarray((shm.size // 8,), dtype=np.float64, buffer=shm.buf))
+
+
+def _spc_segment_task(task):
+    offset, shape, start, end, chart_type, rules, sizes = task
+    n = int(np.prod(shape))
+    data = _shared_data[1][offset:offset+n].reshape(shape)
+    segment = data[start:end]
+    # detached from the shared block before the Spc is pickled back
+    segment = segment.copy()
+    return Spc(segment, chart_type, rules=rules, sizes=sizes)
+
+
+def spc_with_changepoints_many(series, chart_type, change_points=None, rules=RULES_BASIC, sizes=None,
+                               max_workers=None, chunksize=None):
+    """
+    Run spc_with_changepoints over many series in a pool of worker processes.
+    series is a list of arrays, flat or (n, size) for subgroups. change_points
+    is a list with the change points of every series, in the same form as for
+    spc_with_changepoints (ending with the series length); None takes every
+    series as a whole. Per-point sizes are sliced with the segments of every
+    series, like in spc_with_changepoints.
+    The series are copied once into shared memory, so the data is not pickled
+    per task. Segments of all series are spread over max_workers processes.
+    Returns a list with the list of Spc of every series, in the input order.
+    """
+    arrays = [np.asarray(d, dtype=np.float64) for d in series]
+    if change_points is None:
+        change_points = [[len(a)] for a in arrays]
+    assert len(change_points) == len(arrays)
+
+    total = sum(a.size for a in arrays)
+    shm = shared_memory.SharedMemory(create=True, size=max(total, 1) * 8)
+    try:
+        buf = np.ndarray((total,), dtype=np.float64, buffer=shm.buf)
+        tasks = []
+        offset = 0
+        for a, cps in zip(arrays, change_points):
+            buf[offset:offset+a.size] = a.ravel()
+            flag = 0
+            for cp in cps:
+                tasks.append((offset, a.shape, flag, cp, chart_type, rules, _segment_sizes(sizes, flag, cp)))
+                flag = cp
+            offset += a.size
+        del buf
+
+        if chunksize is None:
+            workers = max_workers or os.cpu_count() or 1
+            chunksize = max(1, len(tasks) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_attach_shared_data,
+                                 initargs=(shm.name,)) as executor:
+            spcs = list(executor.map(_spc_segment_task, tasks, chunksize=chunksize))
+    finally:
+        shm.close()
+        shm.unlink()
+
+    results = []
+    pos = 0
+    for cps in change_points:
+        results.append(spcs[pos:pos+len(cps)])
+        pos += len(cps)
+    return results
+
+
 # # DEMO for SPC with Changepoints
 #
 
@@ -0,0 +1,236 @@
+"""
+Benchmarks of SPC.py: limits and prepared data of every chart in STATS_FUNCS,
+the rule sets, spc_with_changepoints and chart rendering, at several data
+sizes. Reports points per second and peak memory (numpy and Python
+allocations, from tracemalloc). Runs offline, the data is generated with a
+fixed seed.
+
+    python benchmark.py                                # all cases, sizes 1e3 .. 1e6
+    python benchmark.py --sizes 1e3,1e5,1e7 --only rules
+    python benchmark.py --save baseline.json
+    python benchmark.py --compare baseline.json        # exit code 1 on a regression
+"""
+
+import argparse
+import io
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import SPC
+
+
+RULE_SETS = (('RULES_BASIC', SPC.RULES_BASIC),
+             ('RULES_WECO', SPC.RULES_WECO),
+             ('RULES_NELSON', SPC.RULES_NELSON),
+             ('RULES_ALL', SPC.RULES_ALL))
+
+GROUPS = ('stats', 'rules', 'changepoints', 'charts')
+
+# points per subgroup of the x-bar charts, sample size of the attribute charts
+# and variables of the multivariate charts
+SUBGROUP_SIZE = 5
+SAMPLE_SIZE = 50
+VARIABLES = 20
+
+# fast cases are repeated until their runs add up to MIN_TOTAL seconds, and
+# cases whose best run is below MIN_COMPARED seconds are too noisy to be
+# flagged as regressions by --compare
+MIN_TOTAL = 1.0
+MAX_RUNS = 1000
+MIN_COMPARED = 1e-3
+
+
+def make_data(chart_type, n, seed=0):
+    """Deterministic data of n points suited to the chart type, with its size."""
+    rng = np.random.default_rng(seed)
+    if chart_type in SPC.SUBGROUP_CHARTS:
+        return rng.normal(size=(n, SUBGROUP_SIZE)), SUBGROUP_SIZE
+    if chart_type in SPC.MULTIVARIATE_CHARTS:
+        # correlated variables
+        mixing = rng.normal(size=(VARIABLES, VARIABLES)) / VARIABLES + np.eye(VARIABLES)
+        return rng.normal(size=(n, VARIABLES)).dot(mixing), VARIABLES
+    if chart_type in (SPC.CHART_P, SPC.CHART_NP):
+        return rng.binomial(SAMPLE_SIZE, 0.1, size=n).astype(float), SAMPLE_SIZE
+    if chart_type in (SPC.CHART_C, SPC.CHART_U):
+        return rng.poisson(4, size=n).astype(float), SAMPLE_SIZE
+    # a slow drift, so the run and trend rules have something to find
+    return rng.normal(size=n) + np.sin(np.arange(n) / 500.0), 1
+
+
+def stats_case(chart_type, n):
+    sf, pd = SPC.STATS_FUNCS[chart_type]
+    data, size = make_data(chart_type, n)
+
+    def run():
+        params = {}
+        if chart_type == SPC.CHART_CUSUM_TABULAR:
+            params = SPC.cusum_tabular_params(data)
+        elif chart_type == SPC.CHART_EWMA:
+            params = SPC.ewma_params(data)
+        elif chart_type == SPC.CHART_T2:
+            params = SPC.t2_params(data)
+        elif chart_type == SPC.CHART_MEWMA:
+            params = SPC.mewma_params(data)
+        sf(data, size, **params)
+        pd(data, size, **params)
+    return run
+
+
+def rules_case(rules, n):
+    data, _ = make_data(SPC.CHART_X_MR_X, n)
+    center, lcl, ucl = SPC.get_stats_x_mr_x(data, 1)
+    return lambda: SPC.find_violating_points(data, center, lcl, ucl, rules)
+
+
+def changepoints_case(n):
+    data, _ = make_data(SPC.CHART_X_MR_X, n)
+    change_points = [n//4, n//2, 3*n//4, n]
+
+    def run():
+        # rules are evaluated lazily, so ask every segment for its violations
+        for spc in SPC.spc_with_changepoints(data, SPC.CHART_X_MR_X, change_points, rules=SPC.RULES_ALL):
+            spc.get_violating_points()
+    return run
+
+
+def chart_case(n):
+    import matplotlib
+    matplotlib.use('Agg')
+    data, _ = make_data(SPC.CHART_X_MR_X, n)
+    spc = SPC.Spc(data, SPC.CHART_X_MR_X, rules=SPC.RULES_ALL)
+    figure = SPC.chart_figure()
+
+    def run():
+        spc.get_chart(figure=figure)
+        figure.savefig(io.BytesIO(), format='png')
+        figure.clear()
+    return run
+
+
+def cases(sizes, only, chart_max):
+    """Yield (group, name, n, make) with make() returning the function to time."""
+    for n in sizes:
+        if 'stats' in only:
+            for chart_type, (sf, pd) in SPC.STATS_FUNCS.items():
+                if sf is None:
+                    continue
+                yield 'stats', chart_type, n, lambda c=chart_type, n=n: stats_case(c, n)
+        if 'rules' in only:
+            for name, rules in RULE_SETS:
+                yield 'rules', name, n, lambda r=rules, n=n: rules_case(r, n)
+        if 'changepoints' in only:
+            yield 'changepoints', 'spc_with_changepoints', n, lambda n=n: changepoints_case(n)
+        if 'charts' in only and n <= chart_max:
+            yield 'charts', 'get_chart', n, lambda n=n: chart_case(n)
+
+
+def measure(func, repeat, memory):
+    """
+    Best wall time of at least repeat runs, more of them for fast cases and
+    only one when it takes long, and the peak memory of one run.
+    """
+    best = None
+    runs = 0
+    total = 0.0
+    while runs < repeat or (total < MIN_TOTAL and runs < MAX_RUNS):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+        runs += 1
+        total += elapsed
+        if elapsed > 5:
+            break
+    peak = None
+    if memory:
+        tracemalloc.start()
+        try:
+            func()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return best, peak
+
+
+def run_benchmarks(sizes, only=GROUPS, repeat=3, memory=True, chart_max=10**5, out=sys.stdout):
+    results = {}
+    out.write('%-40s %10s %12s %14s %10s\n' % ('case', 'points', 'seconds', 'points/s', 'peak MB'))
+    for group, name, n, make in cases(sizes, only, chart_max):
+        seconds, peak = measure(make(), repeat, memory)
+        key = '%s/%s/%d' % (group, name, n)
+        results[key] = {'group': group, 'name': name, 'points': n, 'seconds': seconds,
+                        'points_per_sec': n / seconds if seconds > 0 else float('inf'),
+                        'peak_bytes': peak}
+        out.write('%-40s %10d %12.5f %14.0f %10s\n' % (
+            '%s/%s' % (group, name), n, seconds, results[key]['points_per_sec'],
+            '-' if peak is None else '%.1f' % (peak / 1e6)))
+        out.flush()
+    return results
+
+
+def compare(results, baseline, tolerance, out=sys.stdout):
+    """
+    Print the throughput against the baseline, return the keys slower by more
+    than tolerance. Cases shorter than MIN_COMPARED are shown but not flagged.
+    """
+    regressions = []
+    out.write('\n%-50s %10s %10s\n' % ('case', 'speedup', 'memory'))
+    for key, res in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        speedup = res['points_per_sec'] / base['points_per_sec']
+        memory = '-'
+        if res['peak_bytes'] and base.get('peak_bytes'):
+            memory = '%.2fx' % (res['peak_bytes'] / float(base['peak_bytes']))
+        flag = ''
+        if min(res['seconds'], base['seconds']) < MIN_COMPARED:
+            flag = '  too short'
+        elif speedup < 1 - tolerance:
+            regressions.append(key)
+            flag = '  REGRESSION'
+        out.write('%-50s %9.2fx %10s%s\n' % (key, speedup, memory, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks of SPC.py')
+    parser.add_argument('--sizes', default='1e3,1e4,1e5,1e6',
+                        help='comma separated data sizes, e.g. 1e3,1e5,1e7')
+    parser.add_argument('--only', default=','.join(GROUPS),
+                        help='comma separated groups out of %s' % ', '.join(GROUPS))
+    parser.add_argument('--repeat', type=int, default=3, help='runs per case, the best one counts')
+    parser.add_argument('--chart-max', type=float, default=1e5, help='largest size rendered as a chart')
+    parser.add_argument('--no-memory', action='store_true', help='skip the peak memory run')
+    parser.add_argument('--save', help='write the results as a JSON baseline')
+    parser.add_argument('--compare', help='compare with a JSON baseline written by --save')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='relative throughput loss reported as a regression')
+    args = parser.parse_args(argv)
+
+    sizes = [int(float(s)) for s in args.sizes.split(',')]
+    only = args.only.split(',')
+    assert all(g in GROUPS for g in only)
+    results = run_benchmarks(sizes, only, args.repeat, not args.no_memory, int(args.chart_max))
+
+    if args.save:
+        meta = {'python': platform.python_version(), 'numpy': np.__version__,
+                'machine': platform.machine(), 'platform': platform.platform(),
+                'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+        with open(args.save, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
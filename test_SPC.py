@@ -0,0 +1,75 @@
+"""
+The vectorized rule evaluation against the test_* functions of RULES_FUNCS,
+which check one window at a time and stay the reference for every rule.
+Run with python -m pytest test_SPC.py
+"""
+
+import numpy as np
+import pytest
+
+import SPC
+
+
+def reference_points(data, center, lcl, ucl, rules):
+    """Rule name -> last indexes of the violating windows, one window at a time."""
+    points = {}
+    for i in range(len(data)):
+        for r in rules:
+            func, points_num = SPC.RULES_FUNCS[r]
+            if i <= points_num - 1:
+                continue
+            if func(data[i-points_num+1:i+1], center, lcl, ucl):
+                points.setdefault(r, []).append(i)
+    return points
+
+
+def random_data(seed):
+    rng = np.random.default_rng(seed)
+    return rng.normal(0, 1, 500)
+
+
+def tied_data(seed):
+    # few distinct values, many points exactly on the center and the zone borders
+    rng = np.random.default_rng(seed)
+    return rng.integers(-3, 4, 500).astype(float)
+
+
+def nan_data(seed):
+    data = random_data(seed)
+    rng = np.random.default_rng(seed + 1000)
+    data[rng.integers(0, len(data), 25)] = np.nan
+    return data
+
+
+@pytest.mark.parametrize('make', [random_data, tied_data, nan_data])
+@pytest.mark.parametrize('seed', range(5))
+def test_find_violating_points(make, seed):
+    data = make(seed)
+    center, lcl, ucl = 0.0, -3.0, 3.0
+    if make is random_data:
+        # a drift, so the run and trend rules fire too
+        data = data + np.linspace(0, 2, len(data))
+    expected = reference_points(data, center, lcl, ucl, SPC.RULES_ALL)
+    found = SPC.find_violating_points(data, center, lcl, ucl, SPC.RULES_ALL)
+    assert found == expected
+    assert list(found) == list(expected)
+
+
+@pytest.mark.parametrize('make', [random_data, tied_data])
+def test_rules_stream(make):
+    data = make(0)
+    center, lcl, ucl = 0.0, -3.0, 3.0
+    stream = SPC.RulesStream(center, lcl, ucl, SPC.RULES_ALL)
+    found = {}
+    for i, x in enumerate(data):
+        for r in stream.push(x):
+            found.setdefault(r, []).append(i)
+    expected = reference_points(data, center, lcl, ucl, SPC.RULES_ALL)
+    assert dict((r, sorted(p)) for r, p in found.items()) == expected
+
+
+def test_spc_matches_reference():
+    data = tied_data(1)
+    spc = SPC.Spc(data, SPC.CHART_X_MR_X, rules=SPC.RULES_ALL)
+    center, lcl, ucl = spc.get_stats()
+    assert spc.get_violating_points() == reference_points(spc._data, center, lcl, ucl, SPC.RULES_ALL)